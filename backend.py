@@ -1,26 +1,91 @@
+import codecs
 import json
 import time
 import subprocess
 from dataclasses import dataclass
-from typing import Any, Dict, Optional,  Iterator
+from typing import Any, Callable, Dict, List, Optional,  Iterator, Tuple
 import os
 import threading
-import signal
-import requests
+import shutil
+import copy
+import queue
 import glob
-import socket
+from concurrent.futures import ThreadPoolExecutor
 from cipher import SimpleStringCipher
-from chat_template import Chat_templates
+from chat_template import ChatTemplate, Chat_templates
+from replacer import GscriptReplacer
+from http_client import KoboldHttpClient
+from token_cache import TokenCountCache
+from summary_cache import SummaryCache
+from summary_tree import SummaryTree
+from compresser_manager import CompresserManager
+from downloader import DownloadManager
+from gguf_reader import GGUFInfo, GGUFInfoCache
+from local_tokenizer import LocalTokenizer, TokenizerSlot
+import memory_estimator
+from readiness import ReadinessProbe
+from supervisor import KoboldSupervisor, popen_kobold, terminate_process
+from backend_pool import BackendPool, Cancelled, Generation, GenerationGroup, KoboldEndpoint, SessionState, split_urls
 
 # =========================
 # KoboldCpp backend class
 # =========================
 
+@dataclass(frozen=True)
+class ModelInfo:
+    """
+    読み込み中のモデルについて、モデルを入れ替えるまで変わらない情報
+    """
+    name: str
+    template_name: str
+    template: ChatTemplate  # template.format(本文) でプロンプトにする
+    true_max_context: int
+    tokenizer: str  # トークン数キャッシュのキー（同じトークナイザなら数は同じ）
+
+
+class SSEUnavailable(Exception):
+    """SSE ストリーミングが使えない（エンドポイントが無い等）"""
+
+
+def iter_stream_text(r) -> Iterator[str]:
+    """
+    ストリーミング応答の本文を、届いた分ずつ文字列で返す。
+    koboldcpp の SSE は chunked でも Content-Length 付きでもない（接続を閉じて終わる）ため、
+    iter_content では EOF まで何も返らない。read1() で今読める分だけを読む。
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    read1 = getattr(r.raw, "read1", None)
+    if read1 is None:
+        # urllib3 1.x には read1 が無い。1バイトずつでも届いた順に返す
+        chunks = r.iter_content(chunk_size=1)
+    else:
+        chunks = iter(lambda: read1(65536, decode_content=True), b"")
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
 @dataclass
 class KoboldCppConfig:
     base_url: str = "http://127.0.0.1:5001"
     timeout_sec: int = 180
     kobold_path="koboldcpp"
+    stream_mode: str = "auto"   # "auto": SSE優先で駄目ならポーリング / "sse" / "poll"
+    poll_min_interval: float = 0.02
+    poll_max_interval: float = 0.5
+    token_cache_path: Optional[str] = "cache/token_counts.json"  # None ならディスクに保存しない
+    token_chunk_lines: int = 20  # トークン数をキャッシュする段落の行数
+    window_drop_ratio: float = 0.25  # ウィンドウ方式で一度に空ける予算の割合
+    summary_workers: int = 4  # AI圧縮で同時に要約を投げる数
+    summary_fanout: int = 8  # 階層要約で1つの節にまとめる子の数
+    recent_ratio: float = 0.6  # 階層要約で原文のまま残す割合（予算に対して）
+    max_outstanding: int = 1  # 1つの接続先で同時に走らせる生成の数
+    local_tokenizer: bool = False  # gguf の語彙でトークン数を数える（サーバと照合できた場合だけ）
+    gguf_cache_path: Optional[str] = "cache/gguf_info.json"  # gguf のヘッダから読んだ情報（None なら保存しない）
 
 
 class KoboldCppBackend:
@@ -28,21 +93,51 @@ class KoboldCppBackend:
     KoboldCpp の HTTP API を叩くバックエンド。
     - generate(prompt, params) で文章生成
     - start/stop は任意（koboldcpp 実行ファイルを持っている場合のみ）
+    - 起動したプロセスは KoboldSupervisor が管理する（別モデルへの切り替えは裏で起動してから接続先を切り替える）
+    - base_url を複数指定すると、生成は BackendPool が空いている接続先に振り分ける
+    - セッションごとの状態（ウィンドウ位置・直前のプロンプト）は SessionState に持たせ、生成のたびに渡す
     """
 
     def __init__(self, config: KoboldCppConfig):
         self.temps=Chat_templates()
         self.config = config
-        self._proc: Optional[subprocess.Popen] = None
+        # 起動した koboldcpp の管理（待機インスタンス・切り替え・落ちたときの再起動）
+        self.supervisor=KoboldSupervisor(self._endpoint_ok,self._on_switch)
+        self.readiness: Optional[ReadinessProbe] = None
         self.comp_proc: Optional[subprocess.Popen] = None
-        self.not_first_gen=False
+        # 圧縮用サーバの起動はバックグラウンドで進める
+        self.compresser=CompresserManager(self.setting_aicompresser,
+                                          lambda: self.comp_proc is not None and self.comp_proc.poll() is None)
+        # 接続先ごとに keep-alive のセッション・モデル情報を持つ（メインモデル群 / 圧縮用 5015）
+        self.pool=BackendPool(split_urls(config.base_url) or [config.base_url],read_timeout=config.timeout_sec,max_outstanding=config.max_outstanding)
+        self.endpoint: KoboldEndpoint = self.pool.primary
+        self.config.base_url=self.endpoint.base_url
+        self.comp_http=KoboldHttpClient(read_timeout=config.timeout_sec)
+        # (モデル名, 段落のハッシュ) -> トークン数
+        self.token_cache=TokenCountCache(path=config.token_cache_path)
+        self.token_cache.start_autosave()  # 保存は別スレッドでまとめて（生成のたびには書かない）
+        # チャンク本文のハッシュ -> 要約
+        self.summary_cache=SummaryCache()
+        self.summary_tree=SummaryTree(self.summary_cache,self.send_aicompresser,
+                                      fanout=config.summary_fanout,workers=config.summary_workers)
+        # session を渡さない呼び出し用
+        self.session=SessionState()
+        # gguf から読んだトークナイザ（config.local_tokenizer が有効なとき）。_bind のコピーとも共有する
+        self.tokenizers=TokenizerSlot()
+        # 実行中の生成（キーはセッションなど。同じキーで新しい生成が来たら古い方を止める）
+        self._running: Dict[str, Any] = {}  # Generation / GenerationGroup
+        self._running_lock = threading.Lock()
         self.ssc=SimpleStringCipher("my-password")
+        self.downloads=DownloadManager()
+        # gguf のヘッダ情報（層数・コンテキスト長・チャットテンプレート）。サイズと更新時刻で使い回す
+        self.gguf_info=GGUFInfoCache(config.gguf_cache_path)
+        self._detected_vram: Optional[int] = None  # nvidia-smi で調べたビデオメモリ（None: 未確認）
         if os.path.exists("models/llm.json"):
             with open("models/llm.json",mode="r",encoding="utf-8")as f:
                 self.models=json.load(f)
                 #self.model_list=json.dumps([f'"{item["urls"][0].split("/")[-1:]} : {item["urls"][0]}"' for item in self.models.values()])
             modelfiles=glob.glob("models/*.gguf")
-            for key in self.models.keys():
+            for key in list(self.models.keys()):
                 if "オリジナル" in key:
                     self.models.pop(key)
             for item in modelfiles:
@@ -50,41 +145,45 @@ class KoboldCppBackend:
                 if new_modelname not in [item["urls"][0].split("/")[-1] for item in self.models.values()]:
                     self.models[f"オリジナル/{new_modelname.replace('.gguf','')}"]={"max_gpu_layer":0,"context_size": 4096,"urls":[new_modelname]}
                     #self.model_list=json.dumps([f'"{item["urls"][0].split("/")[-1:]} : {item["urls"][0]}"' for item in self.models.values()]+[])
+            # ダウンロード済みのモデルは層数・コンテキスト長を gguf から埋める
+            for key in self.models.keys():
+                self.refresh_model_spec(key)
         else:
             self.models=None
 
         if os.path.exists("gscript.json"):
-            self.gscript=self.ssc.load_encrypt_json("gscript.json")
+            # 値は置換で実際に使われたときに初めて復号する
+            self.gscript=self.ssc.load_encrypt_json("gscript.json",lazy=True)
         else:
             self.gscript={}
+        self.replacer=GscriptReplacer(self.gscript)
 
     def check_download(self,modelname):
-        path=f"models/{os.path.basename(self.models[modelname]['urls'][0])}"
-        def downloading(path:str,download_path:str):
-            with requests.get(path,stream=True) as r:
-                    r.raise_for_status()
-                    with open(download_path.replace(".gguf",".part"),"wb") as f:
-                        for chunk in r.iter_content(chunk_size=1024*1024):
-                            if chunk:
-                                f.write(chunk)
-                    os.replace(download_path.replace(".gguf",".part"),download_path.replace(".part",".gguf"))
+        """
+        モデルが無ければバックグラウンドでダウンロードを始める。
+        進捗は download_progress(path) で確認する。
+        """
+        model=self.models[modelname]
+        path=self.model_file(modelname)
         if os.path.exists(path):
+            self.refresh_model_spec(modelname)
             return True,path
         else:
-            threading.Thread(target=downloading,args=(self.models[modelname]['urls'][0],path,),daemon=True).start()
+            self.downloads.start(model['urls'][0],path,size=model.get("size"),sha256=model.get("sha256"))
             return False,path
+
+    def download_progress(self,path: str):
+        return self.downloads.progress(path)
     
 
     # ---- HTTP helpers ----
     def _post_json(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
-        url = self.config.base_url.rstrip("/") + path
-        r = requests.post(url, json=payload, timeout=self.config.timeout_sec)
+        r = self.endpoint.http.post(self.endpoint.url(path), json=payload)
         r.raise_for_status()
         return r.json()
     
     def _get_none(self,path: str):
-        url = self.config.base_url.rstrip("/") + path
-        r = requests.get(url, timeout=self.config.timeout_sec)
+        r = self.endpoint.http.get(self.endpoint.url(path))
         r.raise_for_status()
         return r.json()
 
@@ -152,24 +251,156 @@ class KoboldCppBackend:
                 return str(data["data"]["text"])
             return ""
 
-    def generate_polled_stream(self, prompt: str, params: Dict, header: str="", current_text: str="",cut_mode: str="シンプル",exepath: str="koboldcpp",max_tokens: int=1024) -> Iterator[str]:
+    def generate_polled_stream(self, prompt: str, params: Dict, header: str="", current_text: str="",cut_mode: str="シンプル",exepath: str="koboldcpp",max_tokens: int=1024,
+                               session: Optional[SessionState]=None, cancel_key: str="") -> Iterator[str]:
         """
-        1) 別スレッドで /api/v1/generate を投げて生成開始（ブロッキング回避）
-        2) 生成中に /api/extra/generate/check をポーリングして増分を yield
-        3) 生成スレッド終了でループ終了（リトライが詰まらない）
-        """
-        modelname=self._get_none("/api/v1/model")["result"]
-        print(modelname)
-        template=self.temps.templates["chatml"]
-        for temp in self.temps.temp_name.keys():
-            if temp in modelname:
-                template=self.temps.templates[self.temps.temp_name[temp]]
-        
-        formated=self.comp_hub(cut_mode,header,current_text,template,exepath,max_tokens)
+        生成した増分を yield する。
+        1) /api/extra/generate/stream (SSE) が使えればトークンが届くたびにそのまま yield
+        2) SSE が無い環境では、別スレッドで /api/v1/generate を投げつつ
+           /api/extra/generate/check を間隔を伸ばしながらポーリングして増分を yield
+        接続先は BackendPool から借りる（全部使用中なら空くまで待つ）。
+        cancel_key を渡すと cancel(cancel_key) で止められる。同じキーで実行中の生成があれば先に止める。
+        途中でジェネレータを close() した場合も koboldcpp に中断を送る（GPUを空けて次の生成を待たせない）。
+        """
+        session=session if session is not None else self.session
+        gen=Generation()
+        try:
+            if cancel_key:
+                self._register(cancel_key,gen)
+            with self.pool.acquire(session.endpoint,gen.cancelled) as ep:
+                gen.endpoint=ep
+                session.endpoint=ep.base_url
+                try:
+                    yield from self._bind(session,ep)._generate_stream(prompt,params,header,current_text,cut_mode,exepath,max_tokens,gen)
+                    gen.finished=True
+                finally:
+                    # 接続先を返す前に止める
+                    if not gen.finished:
+                        gen.cancel()
+                    gen.finished=True
+        except Cancelled:
+            return
+        finally:
+            if cancel_key:
+                self._unregister(cancel_key,gen)
 
-        
-        if self.check_over_tokens(formated)+max_tokens>0:
+    def max_candidates(self) -> int:
+        """
+        並べて生成できる候補の数（接続先で同時に処理できる生成の数の合計）
+        """
+        return self.pool.capacity()
+
+    def cancel(self, cancel_key: str) -> bool:
+        """
+        cancel_key で実行中の生成を止める。止めるものが無ければ False
+        """
+        with self._running_lock:
+            gen=self._running.get(cancel_key)
+        if gen is None:
+            return False
+        gen.cancel()
+        return True
+
+    def generate_candidates(self, prompt: str, params: Dict, header: str="", current_text: str="",cut_mode: str="シンプル",exepath: str="koboldcpp",max_tokens: int=1024,
+                            k: int=2, session: Optional[SessionState]=None, cancel_key: str="") -> Iterator[tuple[int,str]]:
+        """
+        同じプロンプトから k 本の続きを同時に生成し、(候補番号, 増分) を届いた順に yield する。
+        - プロンプト（圧縮を含む）は1回だけ作る。同じプロンプトなので koboldcpp のキャッシュも効く
+        - 候補ごとに接続先を借りて並列に進める。k は同時に処理できる数（max_candidates()）までに抑える
+        - 取り消しは generate_polled_stream と同じ（cancel_key / close()）
+        """
+        session=session if session is not None else self.session
+        k=max(1,min(k,self.max_candidates()))  # 同時に処理できない分は順番待ちになるだけ
+        group=GenerationGroup(k)
+        try:
+            if cancel_key:
+                self._register(cancel_key,group)
+            payload,over=self._bind(session,self.pool.primary)._build_payload(params,header,current_text,cut_mode,exepath,max_tokens)
+            if over:
+                yield 0,"Over Max Tokens"
+            if group.cancelled.is_set():
+                return
+            deltas: "queue.Queue[tuple[int,Any]]" = queue.Queue()
+
+            def run(i: int, gen: Generation) -> None:
+                try:
+                    with self.pool.acquire(session.endpoint,gen.cancelled) as ep:
+                        gen.endpoint=ep
+                        try:
+                            for delta in self._bind(session,ep)._stream_payload(dict(payload,genkey=gen.genkey),gen):
+                                deltas.put((i,delta))
+                            gen.finished=True
+                        finally:
+                            if not gen.finished:
+                                gen.cancel()
+                            gen.finished=True
+                except Cancelled:
+                    pass
+                except Exception as e:
+                    deltas.put((i,e))
+                finally:
+                    deltas.put((i,None))
+
+            for i,gen in enumerate(group.generations):
+                threading.Thread(target=run,args=(i,gen),daemon=True).start()
+            remaining=k
+            while remaining:
+                i,item=deltas.get()
+                if item is None:
+                    remaining-=1
+                elif isinstance(item,Exception):
+                    yield i,f"\n\n[ERROR] streaming failed: {item}\n"
+                else:
+                    yield i,item
+        finally:
+            # 途中で close() されたら残りの候補も止める
+            if not all(gen.finished for gen in group.generations):
+                group.cancel()
+            if cancel_key:
+                self._unregister(cancel_key,group)
+
+    def _register(self, cancel_key: str, gen: Any) -> None:
+        with self._running_lock:
+            old=self._running.get(cancel_key)
+            self._running[cancel_key]=gen
+        if old is not None:
+            print(f"新しいリトライが来たので前の生成を止めます ({cancel_key})")
+            old.cancel()
+
+    def _unregister(self, cancel_key: str, gen: Any) -> None:
+        with self._running_lock:
+            if self._running.get(cancel_key) is gen:
+                del self._running[cancel_key]
+
+    def _bind(self, session: SessionState, endpoint: KoboldEndpoint) -> "KoboldCppBackend":
+        """
+        1回の生成用に、接続先とセッション状態だけを差し替えた浅いコピーを返す。
+        キャッシュ類（トークン数・要約・置換表）や圧縮用サーバは元のものを共有する。
+        """
+        view=copy.copy(self)
+        view.session=session
+        view.endpoint=endpoint
+        return view
+
+    def _generate_stream(self, prompt: str, params: Dict, header: str, current_text: str, cut_mode: str, exepath: str, max_tokens: int,
+                         gen: Generation) -> Iterator[str]:
+        payload,over=self._build_payload(params,header,current_text,cut_mode,exepath,max_tokens)
+        if over:
             yield "Over Max Tokens"
+        if gen.cancelled.is_set():
+            return  # 圧縮中に取り消された
+        yield from self._stream_payload(dict(payload,genkey=gen.genkey),gen)
+
+    def _build_payload(self, params: Dict, header: str, current_text: str, cut_mode: str, exepath: str, max_tokens: int) -> tuple[Dict[str, Any], bool]:
+        """
+        圧縮したプロンプトから payload を作る。戻り値: (payload, 最大コンテクスト長を超えているか)
+        """
+        info=self.model_info()
+        template=info.template
+        
+        formated=self.comp_hub(cut_mode,header,current_text,template,exepath,max_tokens)
+        self._update_prompt_reuse(formated)
+        over=self.check_over_tokens(formated)+max_tokens>0
 
         payload = {
             "prompt": formated,
@@ -179,6 +410,85 @@ class KoboldCppBackend:
             "rep_pen": float(params.get("repeat_penalty", 1.1)),
             "max_length": int(params.get("max_new_tokens", 400)),
         }
+        return payload,over
+
+    def _stream_payload(self, payload: Dict[str, Any], gen: Generation) -> Iterator[str]:
+        if self.config.stream_mode != "poll" and self.endpoint.sse_supported is not False:
+            try:
+                yield from self._sse_stream(payload,gen)
+                self.endpoint.sse_supported = True
+                return
+            except SSEUnavailable as e:
+                # 一度でも使えなかったら（その接続先では）以降はポーリングに切り替える
+                print(f"SSE stream unavailable, falling back to polling: {e}")
+                self.endpoint.sse_supported = False
+                if self.config.stream_mode == "sse":
+                    raise RuntimeError(str(e))
+
+        yield from self._polled_stream(payload,gen)
+
+    def _sse_stream(self, payload: Dict[str, Any], gen: Generation) -> Iterator[str]:
+        """
+        KoboldCpp の SSE エンドポイントからトークンを受け取って yield する。
+        エンドポイントが無い（404/405/501）か SSE 以外の応答なら SSEUnavailable を投げる。
+        接続エラー・タイムアウトはそのまま投げる（サーバが生成中かもしれないので、ポーリングで投げ直さない）。
+        """
+        url = self.endpoint.url("/api/extra/generate/stream")
+        r = self.endpoint.http.post(url, json=payload, stream=True)
+        with r:
+            if r.status_code in (404, 405, 501):
+                raise SSEUnavailable(f"status {r.status_code}")
+            r.raise_for_status()
+            if "text/event-stream" not in r.headers.get("Content-Type", ""):
+                raise SSEUnavailable(f"unexpected content-type {r.headers.get('Content-Type')}")
+            buf = ""
+            data_lines: list[str] = []
+            for chunk in iter_stream_text(r):
+                if gen.cancelled.is_set():
+                    return
+                buf += chunk
+                while "\n" in buf:
+                    line, buf = buf.split("\n", 1)
+                    line = line.rstrip("\r")
+                    if line.startswith("data:"):
+                        data_lines.append(line[5:].lstrip())
+                        continue
+                    if line or not data_lines:
+                        continue  # event: などは無視、空行でイベント確定
+                    event = "\n".join(data_lines)
+                    data_lines = []
+                    try:
+                        data = json.loads(event)
+                    except json.JSONDecodeError:
+                        continue
+                    token = str(data.get("token", "") or "")
+                    if token:
+                        yield token
+                    if data.get("finish_reason") not in (None, "", "null"):
+                        return
+
+    def _check_text(self, genkey: str = "") -> str:
+        chk = self._post_json("/api/extra/generate/check", {"genkey": genkey} if genkey else {})
+        # よくある形式: {"results":[{"text":"..."}]}
+        if isinstance(chk, dict) and "results" in chk and chk["results"]:
+            return str(chk["results"][0].get("text", "") or "")
+        elif isinstance(chk, dict) and "text" in chk:
+            return str(chk["text"] or "")
+        return ""
+
+    def _polled_stream(self, payload: Dict[str, Any], gen: Generation) -> Iterator[str]:
+        """
+        1) 別スレッドで /api/v1/generate を投げて生成開始（ブロッキング回避）
+        2) 生成中に /api/extra/generate/check をポーリングして増分を yield
+           変化が無い間はポーリング間隔を伸ばし、増分が来たら最短に戻す
+        3) 生成スレッド終了か取り消しでループ終了（リトライが詰まらない）
+        """
+        genkey = gen.genkey
+        # 生成開始前の check は前回の生成結果を返すので、それを古い値として覚えておく
+        try:
+            stale = self._check_text(genkey)
+        except Exception:
+            stale = ""
 
         done = {"flag": False}
         final = {"text": "", "err": None}
@@ -196,17 +506,14 @@ class KoboldCppBackend:
         t.start()
 
         emitted = ""
-        idle_count = 0
+        interval = self.config.poll_min_interval
+        last_change = time.time()
 
-        while not done["flag"]:
+        while not done["flag"] and not gen.cancelled.is_set():
             try:
-                chk = self._post_json("/api/extra/generate/check", {})
-                cur = ""
-                # よくある形式: {"results":[{"text":"..."}]}
-                if isinstance(chk, dict) and "results" in chk and chk["results"]:
-                    cur = str(chk["results"][0].get("text", "") or "")
-                elif isinstance(chk, dict) and "text" in chk:
-                    cur = str(chk["text"] or "")
+                cur = self._check_text(genkey)
+                if not emitted and cur == stale:
+                    cur = ""  # まだ新しい生成が始まっていない
 
                 if cur.startswith(emitted):
                     delta = cur[len(emitted):]
@@ -215,20 +522,21 @@ class KoboldCppBackend:
 
                 if delta:
                     emitted = cur
-                    idle_count = 0
+                    last_change = time.time()
+                    interval = self.config.poll_min_interval
                     yield delta
                 else:
-                    idle_count += 1
+                    interval = min(interval * 1.5, self.config.poll_max_interval)
 
-                # check が機能してない環境で永久待ちにならない保険
-                if idle_count > 200:  # 0.25秒 * 200 = 約50秒 無変化
+                # check が機能してない環境で永久待ちにならない保険（約50秒 無変化）
+                if time.time() - last_change > 50:
                     break
 
             except Exception:
                 # check が無い / 404 / 一時エラーでも、生成スレッドが終われば抜ける
-                pass
+                interval = min(interval * 1.5, self.config.poll_max_interval)
 
-            time.sleep(0.02)
+            gen.cancelled.wait(interval)
 
         # スレッド完了待ち（短く）
         t.join(timeout=0.5)
@@ -248,114 +556,251 @@ class KoboldCppBackend:
 
         
 
-    def abort(self) -> None:
+    def model_info(self) -> ModelInfo:
         """
-        生成中断（対応している場合のみ）
+        モデル名・テンプレート・最大コンテクスト長を1回だけ問い合わせてキャッシュする。
+        start/stop/set_base_url で破棄される。接続先ごとに持つ。
         """
-        for p in ["/api/v1/abort", "/api/abort"]:
-            try:
-                self._post_json(p, {})
-                return
-            except Exception:
-                pass
+        ep=self.endpoint
+        info=ep.model_info
+        if info is not None:
+            return info
+        with ep.model_info_lock:
+            if ep.model_info is None:
+                modelname=str(self._get_none("/api/v1/model")["result"])
+                print(modelname)
+                # 動いているモデルと同じ名前の gguf が手元にあれば、その chat_template を使う
+                gguf_path=f"models/{modelname.split('/')[-1]}.gguf"
+                gguf=self.gguf_info.get(gguf_path) if os.path.exists(gguf_path) else None
+                template=self.temps.resolve(modelname,gguf.chat_template if gguf is not None else "")
+                print(f"chat template: {template.name}")
+                ep.model_info=ModelInfo(
+                    name=modelname,
+                    template_name=template.name,
+                    template=template,
+                    true_max_context=int(self._get_none("/api/extra/true_max_context_length")["value"]),
+                    tokenizer=modelname,
+                )
+                if self.config.local_tokenizer:
+                    # 動いているモデルと同じ名前の gguf があれば語彙を読む（読めていれば照合する）
+                    self.load_local_tokenizer(gguf_path)
+            return ep.model_info
+
+    def invalidate_model_info(self) -> None:
+        for ep in self.pool.endpoints:
+            ep.invalidate()
+
+    def set_base_url(self,base_url: str) -> None:
+        """
+        接続先を設定する。カンマ/空白区切りで複数書くと生成を振り分ける（先頭が起動/終了の対象）。
+        """
+        urls=split_urls(base_url)
+        if not urls or urls==self.pool.urls():
+            return
+        self._set_urls(urls)
+        self.invalidate_model_info()
+
+    def base_urls(self) -> str:
+        return ", ".join(self.pool.urls())
+
+    def _set_urls(self,urls: list) -> None:
+        self.pool.set_urls(urls)
+        self.endpoint=self.pool.primary
+        self.config.base_url=self.endpoint.base_url
+
+    def http_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        接続の再利用状況（keep-alive が効いているかの確認用）と、接続先ごとの処理中の生成数
+        """
+        return dict(self.pool.stats(), compresser=self.comp_http.stats())
+
+    def abort(self, genkey: str = "") -> None:
+        """
+        生成中断（対応している場合のみ）。通常は cancel(cancel_key) を使う
+        """
+        self.endpoint.abort(genkey)
 
     # ---- Optional: start/stop koboldcpp process ----
+    def _kobold_cmd(self, koboldcpp_exe: str, model_path: str, layers: int, context_length: int) -> Callable[[int], list]:
+        def build(port: int) -> list:
+            # 環境によって引数が違うので、必要ならここを調整してください
+            return [
+                koboldcpp_exe,
+                "--model", self.model_file(model_path),
+                "--port", str(port),
+                "--gpulayers", str(layers),
+                "--contextsize", str(context_length)
+            ]
+        return build
+
     def start(self, koboldcpp_exe: str, model_path: str, layers: int = 40, port: int = 5001,context_length: int = 2048) :
         """
         koboldcpp をプロセス起動したい場合用（任意）。
         koboldcpp_exe: koboldcpp の実行ファイルパス（例: ./koboldcpp.exe や ./koboldcpp）
         model_path: gguf のパス
+        すでに別のモデルが動いていれば、空いているポートで新しい方を起動し、準備ができた時点で切り替える
+        （それまでは今のモデルで生成できる）。
         """
-        if self._proc and self._proc.poll() is None:
-            return "すでに起動しています。"
+        key=f"{koboldcpp_exe}|{model_path}|{layers}|{context_length}"
+        build=self._kobold_cmd(koboldcpp_exe, model_path, layers, context_length)
+        active=self.supervisor.active
+        if active is not None and active.alive():
+            if active.key==key:
+                return "すでに起動しています。"
+            inst=self.supervisor.swap(key,build)
+            self.readiness=inst.probe
+            return f"切り替え中（port {inst.port}）: {' '.join(build(inst.port))}"
 
-        cmd = [
-            koboldcpp_exe,
-            "--model", f"models/{self.models[model_path]['urls'][0].split('/')[-1]}",
-            "--port", str(port),
-            "--gpulayers", str(layers),
-            "--contextsize", str(context_length)
-        ]
-        # 環境によって引数が違うので、必要ならここを調整してください
-        self._proc = subprocess.Popen(cmd,
-        text=True,
-        bufsize=1,
-        creationflags=subprocess.CREATE_NEW_PROCESS_GROUP )
-        self.not_first_gen=False
+        self.invalidate_model_info()
+        if self.config.local_tokenizer:
+            # モデルのロード中に語彙を読んでおく
+            self.load_local_tokenizer(self.model_file(model_path))
+        inst=self.supervisor.launch(key,build,port)
+        # 起動待ちは self.readiness で行う（標準出力はロードの進み具合として使う）
+        self.readiness=inst.probe
+        return f"起動コマンド: {' '.join(build(port))}"
+
+    def _vram(self,vram_gb: float) -> int:
+        if vram_gb and vram_gb>0:
+            return int(vram_gb*memory_estimator.GB)
+        if self._detected_vram is None:
+            self._detected_vram=memory_estimator.detect_vram()
+        return self._detected_vram
+
+    def _memory_budget(self,model_path: str,vram_gb: float) -> Tuple[int,int]:
+        """
+        (空きメインメモリ, 使えるビデオメモリ)。別のモデルが動いているときは、切り替えの間は
+        両方が載るので今のモデルの分を引く（メインメモリの空きには最初から含まれていない）。
+        """
+        ram=memory_estimator.available_ram()
+        vram=self._vram(vram_gb)
+        active=self.supervisor.active
+        if vram>0 and active is not None and active.alive():
+            _,active_model,active_layers,active_ctx=active.key.rsplit("|",3)
+            if active_model!=model_path and active_model in self.models:
+                info=self.gguf_info.get(self.model_file(active_model))
+                if info is not None:
+                    vram=max(1,vram-memory_estimator.estimate(info,int(active_layers),int(active_ctx)).vram)
+        return ram,vram
+
+    def recommend_settings(self,model_path: str,vram_gb: float = 0,max_context: int = 20480) -> Tuple[Optional[memory_estimator.Recommendation],str]:
+        """
+        gguf の大きさと空きメモリから --gpulayers / --contextsize のおすすめを出す。
+        """
+        if not self.models or model_path not in self.models:
+            return None,"モデルを選んでください。"
+        info=self.refresh_model_spec(model_path)
+        if info is None:
+            return None,"モデルをダウンロードしてから試してください。"
+        ram,vram=self._memory_budget(model_path,vram_gb)
+        # スライダーと同じ刻みで、学習時の長さまで（recommend は学習時の長さを超えるものは選ばない）
+        max_context=max(max_context,info.context_length)
+        rec=memory_estimator.recommend(info,list(range(2048,max_context+1,2048)),ram,vram)
+        if rec is None:
+            return None,f"メインメモリ（空き {ram/memory_estimator.GB:.1f}GB）に収まらない見込みです。小さいモデルを選んでください。"
+        layers="自動（ビデオメモリが分からないため）" if rec.layers<0 else f"{rec.layers}/{info.max_gpu_layer}"
+        return rec,(f"おすすめ: layers={layers}, context_length={rec.context}\n"
+                    f"見込み: ビデオメモリ {rec.estimate.vram/memory_estimator.GB:.1f}GB / "
+                    f"メインメモリ {rec.estimate.ram/memory_estimator.GB:.1f}GB")
 
-        # 起動待ち（雑に少し待つ）
-        return f"起動コマンド: {' '.join(cmd)}"
+    def check_settings(self,model_path: str,layers: int,context_length: int,vram_gb: float = 0) -> List[str]:
+        """
+        起動前の確認。メモリに収まらない見込みなら理由を返す（gguf が読めなければ確認しない）。
+        """
+        if not self.models or model_path not in self.models:
+            return []
+        info=self.refresh_model_spec(model_path)
+        if info is None:
+            return []
+        ram,vram=self._memory_budget(model_path,vram_gb)
+        return memory_estimator.check(info,layers,context_length,ram,vram)
 
+    def prepare_standby(self, koboldcpp_exe: str, model_path: str, layers: int = 40, context_length: int = 2048) -> str:
+        """
+        次に使うモデルを裏で起動しておく。その後 start() で同じモデルを選ぶとすぐ切り替わる。
+        """
+        key=f"{koboldcpp_exe}|{model_path}|{layers}|{context_length}"
+        inst=self.supervisor.prepare_standby(key,self._kobold_cmd(koboldcpp_exe, model_path, layers, context_length))
+        return f"待機用に起動中（port {inst.port}）"
+
+    def probe_ready(self) -> ReadinessProbe:
+        """
+        起動完了を待つプローブを返す。
+        自分で起動したプロセスがあればそれを、無ければ（外部起動の場合）APIだけを確認するプローブを作る。
+        """
+        if self.readiness is None or (self.readiness.done() and not self.readiness.ready.is_set()):
+            active=self.supervisor.active
+            self.readiness=ReadinessProbe(self._model_endpoint_ok,active.proc if active else None).start()
+        return self.readiness
+
+    def _model_endpoint_ok(self) -> bool:
+        return self._endpoint_ok(self.config.base_url)
+
+    def _endpoint_ok(self, base_url: str) -> bool:
+        url = base_url.rstrip("/") + "/api/v1/model"
+        r = self.endpoint.http.get(url, timeout=(1, 2))
+        return r.status_code == 200
+
+    def _on_switch(self, base_url: str) -> None:
+        """
+        KoboldSupervisor から呼ばれる（切り替え完了・再起動時）
+        """
+        self._set_urls([base_url]+self.pool.urls()[1:])
+        self.endpoint.invalidate()
+        active=self.supervisor.active
+        if active is not None:
+            self.readiness=active.probe
 
     def stop(self) -> str:
-        if not self._proc:
+        if self.supervisor.active is None and self.supervisor.standby is None and self.supervisor.pending is None:
             return "起動していません。"
-        if self._proc.poll() is None:
-            self._proc.send_signal(signal.CTRL_BREAK_EVENT)
-            self._proc.terminate()
-            try:
-                self._proc.wait(timeout=5)
-                self._proc.kill()
-                print(self._proc.poll())
-            except subprocess.TimeoutExpired:
-                self._proc.kill()
-        self._proc = None
+        self.supervisor.stop_all()
+        self.readiness = None
+        self.invalidate_model_info()
         return "終了しました。"
 
     def reload_gscript(self,path: str):
         if os.path.exists(path):
-            self.gscript=self.ssc.load_encrypt_json(path)
+            self.gscript=self.ssc.load_encrypt_json(path,lazy=True)
+            self.replacer=GscriptReplacer(self.gscript)
             return None
 
 #コンテクスト長圧縮用処理
-    def setting_aicompresser(self,exepath: str):
-        path="models\LFM2.5-1.2B-JP-Q8_0.gguf"
-        def downloading(path:str,download_path:str):
-            with requests.get(path,stream=True) as r:
-                    r.raise_for_status()
-                    with open(download_path.replace(".gguf",".part"),"wb") as f:
-                        for chunk in r.iter_content(chunk_size=1024*1024):
-                            if chunk:
-                                f.write(chunk)
-                    os.replace(download_path.replace(".gguf",".part"),download_path.replace(".part",".gguf"))
+    def setting_aicompresser(self,exepath: str,on_state: Optional[Callable[[str],None]]=None):
+        """
+        圧縮用モデルのダウンロードと起動（同期）。通常は CompresserManager から別スレッドで呼ばれる。
+        """
+        path="models/LFM2.5-1.2B-JP-Q8_0.gguf"
         if os.path.exists(path):
             pass
         else:
-            result=threading.Thread(target=downloading,args=("https://huggingface.co/LiquidAI/LFM2.5-1.2B-JP-GGUF/resolve/main/LFM2.5-1.2B-JP-Q8_0.gguf?download=true",path,),daemon=True)
-            result.run()
-            result.join(timeout=300)
+            if on_state:
+                on_state(CompresserManager.DOWNLOADING)
+            self.downloads.download("https://huggingface.co/LiquidAI/LFM2.5-1.2B-JP-GGUF/resolve/main/LFM2.5-1.2B-JP-Q8_0.gguf?download=true",path)
+        if on_state:
+            on_state(CompresserManager.STARTING)
         if self.comp_proc and self.comp_proc.poll() is None:
             return "すでに起動しています。"
-        if not os.path.exists(exepath+".exe"):
-            return f"{exepath}.exeが見つかりません"
+        if not (os.path.exists(exepath) or os.path.exists(exepath+".exe") or shutil.which(exepath)):
+            return f"{exepath}が見つかりません"
 
         cmd = [
             exepath,
-            "--model", "models\LFM2.5-1.2B-JP-Q8_0.gguf",
+            "--model", path,
             "--port", "5015",
             "--gpulayers", "0",
             "--contextsize", "2048"
         ]
         # 環境によって引数が違うので、必要ならここを調整してください
-        self.comp_proc = subprocess.Popen(cmd,
-        text=True,
-        bufsize=1,
-        creationflags=subprocess.CREATE_NEW_PROCESS_GROUP )
+        self.comp_proc = popen_kobold(cmd,capture=False)
         return "起動完了"
     
     def stop_aicompesser(self):
         if not self.comp_proc:
             return "起動していません。"
-        if self.comp_proc.poll() is None:
-            self.comp_proc.send_signal(signal.CTRL_BREAK_EVENT)
-            self.comp_proc.terminate()
-            try:
-                self.comp_proc.wait(timeout=5)
-                self.comp_proc.kill()
-                print(self.comp_proc.poll())
-            except subprocess.TimeoutExpired:
-                self.comp_proc.kill()
+        terminate_process(self.comp_proc)
         self.comp_proc = None
+        self.compresser.mark_stopped()
         return "終了しました。"
     
     def send_aicompresser(self,text: str):
@@ -387,7 +832,7 @@ class KoboldCppBackend:
         for p in candidates:
             try:
                 url = "http://127.0.0.1:5015"+p
-                r = requests.post(url, json=payload, timeout=self.config.timeout_sec)
+                r = self.comp_http.post(url, json=payload)
                 r.raise_for_status()
                 data = r.json()
                 # 返却形式候補を吸収
@@ -421,78 +866,368 @@ class KoboldCppBackend:
         :param text: 説明
         :type text: str
         """
-        token_values=int(self._post_json("/api/extra/tokencount",{"prompt":text})["value"])
-        true_max_context_length=int(self._get_none("/api/extra/true_max_context_length")["value"])
+        token_values=self.check_current_token(text)
+        true_max_context_length=self.get_true_max_context()
         print(f"check current token {token_values}/{true_max_context_length}")
         return token_values-true_max_context_length
     
     def check_current_token(self,text: str):
+        return self.token_cache.count(self._token_model(),text,self._tokencount)
+
+    def _tokencount(self,text: str) -> int:
+        tok=self.local_tokenizer
+        if self.config.local_tokenizer and tok is not None and tok.verified:
+            return tok.count(text)
+        return self._server_tokencount(text)
+
+    def _server_tokencount(self,text: str) -> int:
         return int(self._post_json("/api/extra/tokencount",{"prompt":text})["value"])
+
+    def model_file(self,modelname: str) -> str:
+        return f"models/{os.path.basename(self.models[modelname]['urls'][0])}"
+
+    def refresh_model_spec(self,modelname: str) -> Optional[GGUFInfo]:
+        """
+        ダウンロード済みなら gguf のヘッダを読み、models[modelname] の max_gpu_layer と
+        context_size を実際の値にする。無い/読めないときは llm.json の値のまま。
+        """
+        info=self.gguf_info.get(self.model_file(modelname))
+        if info is None:
+            return None
+        self.gguf_info.save()  # 読み直したときだけ書く
+        model=self.models[modelname]
+        if info.max_gpu_layer:
+            model["max_gpu_layer"]=info.max_gpu_layer
+        if info.context_length:
+            model["context_size"]=info.context_length
+        if info.architecture:
+            model["architecture"]=info.architecture
+        return info
+
+    def load_local_tokenizer(self,path: str) -> None:
+        """
+        gguf から語彙を読む（別スレッド）。サーバが動いていれば /api/extra/tokencount と照合し、
+        一致したときだけ _tokencount で使う。一致しなければ今まで通りサーバで数える。
+        """
+        if not os.path.exists(path):
+            return
+        slot=self.tokenizers
+        if not slot.begin(path):
+            tok=slot.tokenizer
+            if tok is not None and tok.name==path:
+                threading.Thread(target=self._verify_local_tokenizer,daemon=True).start()
+            return
+
+        def run():
+            loaded=None
+            try:
+                t=time.time()
+                loaded=LocalTokenizer.from_gguf(path)
+                print(f"local tokenizer loaded: {path} ({time.time()-t:.1f}s)")
+            except Exception as e:
+                print(f"local tokenizer unavailable: {e}")
+                return
+            finally:
+                slot.finish(path,loaded)
+            self._verify_local_tokenizer()
+
+        threading.Thread(target=run,daemon=True).start()
+
+    @property
+    def local_tokenizer(self) -> Optional[LocalTokenizer]:
+        return self.tokenizers.tokenizer
+
+    def _verify_local_tokenizer(self) -> None:
+        tok=self.local_tokenizer
+        info=self.endpoint.model_info
+        if tok is None or tok.verified is not None or info is None:
+            return  # 照合済み / サーバの準備がまだ（model_info() のときにもう一度呼ばれる）
+        if os.path.basename(tok.name).removesuffix(".gguf")!=info.name.split("/")[-1]:
+            return  # 動いているモデルと違う gguf
+        try:
+            ok=tok.verify(self._server_tokencount)
+        except Exception as e:
+            print(f"local tokenizer check failed: {e}")
+            return
+        if ok:
+            print(f"local tokenizer matches the server (offset {tok.offset})")
+        else:
+            print("local tokenizer does not match the server; counting tokens on the server")
+
+    def _token_model(self) -> str:
+        # トークン数キャッシュのキー
+        return self.model_info().tokenizer
+
+    def _count_cached(self,text: str) -> int:
+        return self.token_cache.count(self._token_model(),text,self._tokencount)
+
+    def get_true_max_context(self) -> int:
+        return self.model_info().true_max_context
+
+    def _chunk_counts(self,texts:list[str]) -> list[int]:
+        """
+        token_chunk_lines 行ごとの段落のトークン数（キャッシュ済み）。+1 は段落間の改行
+        """
+        n=self.config.token_chunk_lines
+        return [self._count_cached("\n".join(texts[i:i+n]))+1 for i in range(0,len(texts),n)]
+
+    def _estimate_tokens(self,texts:list[str], header: str, template: ChatTemplate) -> int:
+        """
+        全文のプロンプトのトークン数の見積もり（段落ごとの数の合計。全文は数えない）
+        """
+        return self._count_cached(template.format(header))+sum(self._chunk_counts(texts))
+
+    def _estimate_cut(self,texts:list[str], header: str, template: ChatTemplate, target: int) -> tuple[int,int]:
+        """
+        キャッシュ済みの段落ごとのトークン数から、target に収まる最初の行を見積もる。
+        段落単位の累積和で大まかに切ってから、境目の段落だけ行単位で詰める。
+        戻り値: (残す最初の行, 見積もりトークン数)
+        """
+        n=self.config.token_chunk_lines
+        overhead=self._count_cached(template.format(header))
+        chunk_counts=self._chunk_counts(texts)
+        # suffix[k]: k番目以降の段落をすべて残したときの本文トークン数
+        suffix=[0]*(len(chunk_counts)+1)
+        for k in range(len(chunk_counts)-1,-1,-1):
+            suffix[k]=suffix[k+1]+chunk_counts[k]
+        k=0
+        while k<len(chunk_counts) and overhead+suffix[k]>=target:
+            k+=1
+        if k==0:
+            return 0,overhead+suffix[0]
+        start=(k-1)*n
+        lines=texts[start:start+n]
+        rest=suffix[k]
+        first=start+len(lines)
+        for i in range(len(lines)-1,-1,-1):
+            line_tokens=self._count_cached(lines[i])+1
+            if overhead+rest+line_tokens>=target:
+                break
+            rest+=line_tokens
+            first=start+i
+        return first,overhead+rest
     
-    def simple_compresser(self,texts:list[str], header: str, template: str, max_tokens: int):
-        over=True
-        formated=template.format(header + "\n".join(texts))
-        over_length=self.check_over_tokens(formated)+max_tokens
-        current_length=self.check_current_token("\n".join(texts))
-        first_sentence=int(len(texts)*over_length/current_length)
-        while over:
-            new_texts=texts[first_sentence:]
-            if self.check_over_tokens(template.format(header + "\n".join(new_texts)))+max_tokens<0:
-                over=False
+    def simple_compresser(self,texts:list[str], header: str, template: ChatTemplate, max_tokens: int):
+        return "\n".join(texts[self._simple_cut(texts,header,template,max_tokens):])
+
+    def _simple_cut(self,texts:list[str], header: str, template: ChatTemplate, max_tokens: int) -> int:
+        """
+        先頭から何行落とせば収まるかを求め、残す最初の行を返す。
+        1) 段落ごとのトークン数（キャッシュ済み）の累積和から切る位置を見積もる
+        2) その位置のプロンプトだけ正確に数えて確認する（同じプロンプトならそれもキャッシュ）
+        3) 見積もりが外れたら誤差分だけ予算を詰めて探し直し、それでも駄目なら二分探索
+        """
+        budget=self.get_true_max_context()-max_tokens
+
+        def fits(first_sentence: int) -> bool:
+            prompt=template.format(header + "\n".join(texts[first_sentence:]))
+            return self.check_current_token(prompt)<budget
+
+        target=budget
+        lo=0
+        for _ in range(3):
+            first,estimated=self._estimate_cut(texts,header,template,target)
+            prompt=template.format(header + "\n".join(texts[first:]))
+            tokens=self.check_current_token(prompt)
+            if tokens<budget:
+                return first
+            lo=max(lo,first)
+            if tokens<=estimated or first>=len(texts):
+                break
+            target-=tokens-estimated
+
+        # 見積もりが当てにならない場合は正確な数で二分探索（tokencount は O(log 行数) 回）
+        # lo: 収まらないことが分かっている位置 / hi: 収まる位置（全部落とせば収まるとみなす）
+        hi=len(texts)
+        while hi-lo>1:
+            mid=(lo+hi)//2
+            if fits(mid):
+                hi=mid
             else:
-                first_sentence+=1
-        return "\n".join(new_texts)
+                lo=mid
+        if hi==len(texts) and not fits(hi):
+            print("header alone exceeds the context budget")
+        return hi
     
-    def ai_compresser(self,texts:list[str], header: str, template: str, max_tokens: int):
-        n = 20
+    def _ensure_aicompresser(self) -> bool:
+        """
+        圧縮用サーバが使えるか。まだなら起動だけ始めて False を返す（生成は待たせない）
+        """
+        if self.compresser.is_ready():
+            return True
+        self.compresser.prewarm(self.config.kobold_path)
+        print(self.compresser.status_text())
+        return False
+
+    def ai_compresser(self,texts:list[str], header: str, template: ChatTemplate, max_tokens: int):
+        n = self.config.token_chunk_lines
         chunks = [texts[i:i + n] for i in range(0, len(texts), n)]
-        if self.comp_proc and self.comp_proc.poll() is None:
-            pass
-        else:
-            print(self.setting_aicompresser(exepath=self.config.kobold_path))
-            def is_listening(host: str="127.0.0.1",port: int = 5015, timeout: float =0.3)-> bool:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        s.settimeout(timeout)
-                        return s.connect_ex((host, port)) == 0
-            while not is_listening():
-                time.sleep(0.1)
-        over=True
+        if not self._ensure_aicompresser():
+            # 準備ができるまではシンプル圧縮で代用する
+            return self.simple_compresser(texts,header,template,max_tokens)
+        budget=self.get_true_max_context()-max_tokens
+        # 超過量の計算はキャッシュ済みのトークン数で行い、収まりそうなときだけ正確に数える
+        overhead=self._count_cached(template.format(header))
+        chunk_texts=["\n".join(item) for item in chunks]
+        chunk_counts=[self._count_cached(item) for item in chunk_texts]
+        # 前回までに要約したチャンクは使い回す
+        summaries: list[Optional[str]]=[self.summary_cache.get(item) for item in chunk_texts]
+        workers=max(1,self.config.summary_workers)
+
+        def summarize(i: int) -> str:
+            summary=self.send_aicompresser(chunk_texts[i])
+            self.summary_cache.put(chunk_texts[i],summary)
+            return summary
+
         current_index=0
-        comped_chunks=[]
-        while over:
-            comped_chunks.append(self.send_aicompresser("\n".join(chunks[current_index])))
-            new_raw_text=""
-            for item in comped_chunks:
-                new_raw_text+=item
-            for item in chunks[len(comped_chunks):]:
-                new_raw_text+="\n".join(item)
-            new_texts=template.format(header + new_raw_text)
-            length=self.check_over_tokens(new_texts)
-            if length+max_tokens<0:
-                over=False
-            current_index+=1
+        new_raw_text="\n".join(texts)
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            while current_index<len(chunks):
+                if summaries[current_index] is None:
+                    # 未要約なら、この先のチャンクもまとめて並列に要約しておく（次のリトライでも使える）
+                    batch=[i for i in range(current_index,min(current_index+workers,len(chunks))) if summaries[i] is None]
+                    for i,summary in zip(batch,ex.map(summarize,batch)):
+                        summaries[i]=summary
+                current_index+=1
+                new_raw_text=""
+                for item in summaries[:current_index]:
+                    new_raw_text+=item
+                for item in chunk_texts[current_index:]:
+                    new_raw_text+=item
+                estimated=overhead+sum(self._count_cached(item) for item in summaries[:current_index])+sum(chunk_counts[current_index:])
+                if estimated<budget and self.check_current_token(template.format(header + new_raw_text))<budget:
+                    break
         return new_raw_text
     
-    def comp_hub(self,mode: str,header: str, current_text:str, template: str,exepath: str, max_tokens: int):  
+    def tree_compresser(self,texts:list[str], header: str, template: ChatTemplate, max_tokens: int):
+        """
+        階層要約方式: 「古い本文の要約（SummaryTree）+ 最近の本文そのまま」でプロンプトを作る。
+        最近の本文は予算の recent_ratio まで末尾から段落単位で残し、それより前は要約に置き換える。
+        要約は本文が変わった部分だけ作り直すので、小説がどれだけ長くてもほぼ一定の手間で済む。
+        """
+        if not self._ensure_aicompresser():
+            return self.simple_compresser(texts,header,template,max_tokens)
+        budget=self.get_true_max_context()-max_tokens
+        n=self.config.token_chunk_lines
+        overhead=self._count_cached(template.format(header))
+        chunk_texts=["\n".join(texts[i:i+n]) for i in range(0,len(texts),n)]
+
+        # 末尾から、予算の recent_ratio に収まるだけ原文のまま残す
+        recent_budget=int((budget-overhead)*self.config.recent_ratio)
+        first_recent=len(chunk_texts)
+        used=0
+        while first_recent>0:
+            tokens=self._count_cached(chunk_texts[first_recent-1])+1
+            if used+tokens>=recent_budget:
+                break
+            used+=tokens
+            first_recent-=1
+
+        old=self.summary_tree.summaries_for(chunk_texts[:first_recent])
+        # 要約部分も入りきらなければ、古い要約から落とす
+        room=budget-overhead-used
+        old_counts=[self._count_cached(item)+1 for item in old]
+        while old and sum(old_counts)>=room:
+            old.pop(0)
+            old_counts.pop(0)
+
+        result="\n".join(old+chunk_texts[first_recent:])
+        if self.check_current_token(template.format(header+result))>=budget:
+            # 見積もりが外れたときは行単位で確実に収める
+            lines=result.split("\n")
+            result="\n".join(lines[self._simple_cut(lines,header,template,max_tokens):])
+        return result
+
+    def export_summaries(self,text: str) -> Dict[str,str]:
+        """
+        text に関係する要約だけを返す（json保存用）
+        """
+        texts=text.split("\n")
+        n=self.config.token_chunk_lines
+        return self.summary_tree.export_for(["\n".join(texts[i:i+n]) for i in range(0,len(texts),n)])
+
+    def import_summaries(self,summaries: Dict[str,str]) -> None:
+        self.summary_cache.update(summaries)
+
+    def window_compresser(self,texts:list[str], header: str, template: ChatTemplate, max_tokens: int):
+        """
+        KoboldCpp のKVキャッシュを使い回すためのウィンドウ方式。
+        - 切るときは予算の window_drop_ratio 分まとめて空け、段落の境目で切る
+        - 以降のリトライでは収まる限り同じ位置から始めるので、プロンプトの先頭が変わらない
+          （1行ずつ落とすと毎回先頭がずれて、プロンプト全体の再計算になる）
+        """
+        budget=self.get_true_max_context()-max_tokens
+        n=self.config.token_chunk_lines
+
+        def prompt_from(first: int) -> str:
+            return template.format(header + "\n".join(texts[first:]))
+
+        start=self.session.window_start
+        if start is not None and start<=len(texts) and self.check_current_token(prompt_from(start))<budget:
+            return "\n".join(texts[start:])
+
+        target=int(budget*(1-self.config.window_drop_ratio))
+        first,_=self._estimate_cut(texts,header,template,target)
+        first=min(-(-first//n)*n,len(texts))  # 段落の境目まで切り上げ
+        if self.check_current_token(prompt_from(first))>=budget:
+            # 見積もりが外れたときは行単位の方式で確実に収める
+            first=self._simple_cut(texts,header,template,max_tokens)
+        self.session.window_start=first
+        return "\n".join(texts[first:])
+
+    def _update_prompt_reuse(self,prompt: str) -> None:
+        """
+        直前のプロンプトと先頭が何文字一致しているか（= KVキャッシュを再利用できそうな量）を記録する
+        """
+        last=self.session.last_prompt
+        limit=min(len(last),len(prompt))
+        same=0
+        step=4096
+        while same<limit:
+            end=min(same+step,limit)
+            if last[same:end]==prompt[same:end]:
+                same=end
+                continue
+            while same<end and last[same]==prompt[same]:
+                same+=1
+            break
+        self.session.last_prompt=prompt
+        self.session.prompt_reuse={"chars":same,"ratio":same/len(prompt) if prompt else 0.0}
+        print(f"prompt reuse {same}/{len(prompt)} chars")
+
+    def comp_hub(self,mode: str,header: str, current_text:str, template: ChatTemplate,exepath: str, max_tokens: int):  
         formatted=template.format(header+current_text)
-        if self.check_over_tokens(formatted)+max_tokens<0:
-            return formatted
         texts=current_text.split("\n")
+        # 全文を毎回 tokencount に送らない。段落ごとの数（キャッシュ済み）の合計で判断し、
+        # 予算の境目に近いときだけ全文を正確に数える（段落の継ぎ目の誤差は margin に収まる）
+        budget=self.get_true_max_context()-max_tokens
+        estimated=self._estimate_tokens(texts,header,template)
+        margin=max(64,estimated//50)
+        print(f"estimated tokens {estimated}/{budget}")
+        if estimated<budget-margin or (estimated<budget+margin and self.check_over_tokens(formatted)+max_tokens<0):
+            self.session.window_start=None  # 全文が収まるなら窓は不要
+            return formatted
         print(mode)
         mode_dict={
             "シンプル":1,
-            "AI圧縮":2
+            "AI圧縮":2,
+            "ウィンドウ":3,
+            "階層要約":4
         }
         match mode_dict[mode]:
             case 1:
                 print(1)
-                self.stop_aicompesser()
                 result=self.simple_compresser(texts,header,template,max_tokens)
             case 2:
                 print(2)
                 result=self.ai_compresser(texts,header,template,max_tokens)
+            case 3:
+                print(3)
+                result=self.window_compresser(texts,header,template,max_tokens)
+            case 4:
+                print(4)
+                result=self.tree_compresser(texts,header,template,max_tokens)
             case _:
                 result=""
                 print(3)
-        print(result)
         return template.format(header+result)
\ No newline at end of file
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import re
+import threading
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from http_client import KoboldHttpClient
+
+
+def split_urls(text: str) -> List[str]:
+    """
+    "http://a:5001, http://b:5001" のようなカンマ/空白区切りの指定を分ける
+    """
+    return [u.rstrip("/") for u in re.split(r"[,\s]+", text) if u]
+
+
+@dataclass
+class SessionState:
+    """
+    セッション（ブラウザのタブ）ごとの状態。共有のバックエンドには持たせず、gr.State に入れて持ち回る。
+    """
+    window_start: Optional[int] = None   # ウィンドウ方式の切り位置（行番号）
+    last_prompt: str = ""                # 直前に送ったプロンプト
+    prompt_reuse: Dict[str, float] = field(default_factory=lambda: {"chars": 0, "ratio": 0.0})
+    endpoint: str = ""                   # 前回使った接続先（KVキャッシュが残っているので空いていれば優先する）
+
+
+class KoboldEndpoint:
+    """
+    koboldcpp の接続先1つ分。モデル情報・SSE対応の有無・keep-alive セッションは接続先ごとに持つ。
+    """
+
+    def __init__(self, base_url: str, read_timeout: float = 180, max_outstanding: int = 1):
+        self.base_url = base_url.rstrip("/")
+        self.http = KoboldHttpClient(read_timeout=read_timeout)
+        self.max_outstanding = max(1, max_outstanding)
+        self.outstanding = 0   # 処理中の生成数
+        self.served = 0        # 割り当てた回数（同数のときに順番に回すため）
+        self.model_info: Any = None
+        self.model_info_lock = threading.Lock()
+        self.sse_supported: Optional[bool] = None  # None: 未確認
+
+    def url(self, path: str) -> str:
+        return self.base_url + path
+
+    def invalidate(self) -> None:
+        with self.model_info_lock:
+            self.model_info = None
+        self.sse_supported = None
+
+    def abort(self, genkey: str = "") -> bool:
+        """
+        生成を中断する。genkey を渡すとその生成だけを止める（他のユーザーの生成は止めない）。
+        """
+        payload = {"genkey": genkey} if genkey else {}
+        for p in ["/api/extra/abort", "/api/v1/abort", "/api/abort"]:
+            try:
+                r = self.http.post(self.url(p), json=payload, timeout=(1, 5))
+                if r.status_code == 200:
+                    return True
+            except Exception:
+                pass
+        return False
+
+
+class Cancelled(Exception):
+    """生成が始まる前に取り消された"""
+
+
+class Generation:
+    """
+    実行中の生成1つ分。cancel() で koboldcpp に中断を送り、ストリームのポーリングも止める。
+    """
+
+    def __init__(self):
+        self.genkey = f"KCPP{uuid.uuid4().hex[:8]}"
+        self.endpoint: Optional[KoboldEndpoint] = None  # 接続先が決まるまで None
+        self.cancelled = threading.Event()
+        self.finished = False
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+        ep = self.endpoint
+        if ep is not None and not self.finished:
+            ep.abort(self.genkey)
+
+
+class GenerationGroup:
+    """
+    同じプロンプトから並べて生成する候補たち。cancel() でまとめて止める。
+    """
+
+    def __init__(self, k: int):
+        self.generations = [Generation() for _ in range(k)]
+        self.cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+        for gen in self.generations:
+            gen.cancel()
+
+
+class BackendPool:
+    """
+    複数の koboldcpp に生成を振り分ける。
+    - 処理中の生成が一番少ない接続先を選ぶ（同数なら前回と同じ接続先 → 割り当て回数が少ない順）
+    - どこも max_outstanding に達していれば空くまで待つ。待っている順に割り当てるので、
+      同時に処理できる数（= 待たずに生成できるユーザー数）は接続先の数に合わせて増減する
+    - 先頭の接続先が起動/終了（KoboldSupervisor）の対象で、トークン数などの問い合わせにも使う
+    """
+
+    def __init__(self, urls: List[str], read_timeout: float = 180, max_outstanding: int = 1):
+        self.read_timeout = read_timeout
+        self.max_outstanding = max_outstanding
+        self.endpoints: List[KoboldEndpoint] = [KoboldEndpoint(u, read_timeout, max_outstanding) for u in urls]
+        self._cond = threading.Condition()
+        self._waiting: Deque[object] = deque()
+
+    @property
+    def primary(self) -> KoboldEndpoint:
+        return self.endpoints[0]
+
+    def urls(self) -> List[str]:
+        return [ep.base_url for ep in self.endpoints]
+
+    def capacity(self) -> int:
+        return sum(ep.max_outstanding for ep in self.endpoints)
+
+    def set_urls(self, urls: List[str]) -> None:
+        """
+        接続先を入れ替える。同じ URL の接続先はそのまま使い回す（処理中の生成はそのまま続く）。
+        """
+        with self._cond:
+            current = {ep.base_url: ep for ep in self.endpoints}
+            self.endpoints = [current.get(u.rstrip("/")) or KoboldEndpoint(u, self.read_timeout, self.max_outstanding)
+                              for u in urls]
+            self._cond.notify_all()
+
+    @contextmanager
+    def acquire(self, prefer: str = "", cancelled: Optional[threading.Event] = None) -> Iterator[KoboldEndpoint]:
+        """
+        接続先を1つ借りる。待っている間に cancelled が立ったら Cancelled を投げる。
+        """
+        ep = self._acquire(prefer, cancelled)
+        try:
+            yield ep
+        finally:
+            self._release(ep)
+
+    def _acquire(self, prefer: str, cancelled: Optional[threading.Event]) -> KoboldEndpoint:
+        ticket = object()
+        with self._cond:
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    if cancelled is not None and cancelled.is_set():
+                        raise Cancelled()
+                    if self._waiting[0] is ticket:
+                        ep = self._pick(prefer)
+                        if ep is not None:
+                            ep.outstanding += 1
+                            ep.served += 1
+                            return ep
+                    # 取り消しに気づけるように、時々起きて確認する
+                    self._cond.wait(timeout=0.5)
+            finally:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+
+    def _pick(self, prefer: str) -> Optional[KoboldEndpoint]:
+        free = [ep for ep in self.endpoints if ep.outstanding < ep.max_outstanding]
+        if not free:
+            return None
+        return min(free, key=lambda ep: (ep.outstanding, ep.base_url != prefer, ep.served))
+
+    def _release(self, ep: KoboldEndpoint) -> None:
+        with self._cond:
+            ep.outstanding -= 1
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {ep.base_url: dict(ep.http.stats(), outstanding=ep.outstanding, served=ep.served)
+                for ep in self.endpoints}
@@ -1,4 +1,66 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+try:
+    # gradio の依存として入っている
+    from jinja2.sandbox import ImmutableSandboxedEnvironment
+except ImportError:  # pragma: no cover
+    ImmutableSandboxedEnvironment = None
+
+# 本文の位置を探すための目印（テンプレートに出てこない文字列）
+_SENTINEL = "本文"
+
+
+@dataclass(frozen=True)
+class ChatTemplate:
+    """
+    本文を1つの user 発話として包むテンプレート。前後の文字列に分けておき、format は連結するだけ。
+    （プロンプトを組み立てるたびに書式文字列を解釈しない。str と同じく template.format(本文) で使える）
+    """
+    name: str
+    prefix: str
+    suffix: str
+
+    def format(self, content: str) -> str:
+        return self.prefix + content + self.suffix
+
+    @classmethod
+    def compile(cls, name: str, fmt: str) -> "ChatTemplate":
+        prefix, sep, suffix = fmt.partition("{}")
+        if not sep:
+            raise ValueError(f"テンプレート {name} に {{}} がありません")
+        return cls(name, prefix, suffix)
+
+
+def render_jinja(source: str) -> Optional[Tuple[str, str]]:
+    """
+    gguf の tokenizer.chat_template（Jinja）を user 発話1つ + add_generation_prompt で描画し、
+    本文の前後に分ける。jinja2 が無い・描画できないときは None。
+    BOS は koboldcpp が付けるので空にする。
+    """
+    if ImmutableSandboxedEnvironment is None or not source:
+        return None
+
+    def raise_exception(message: str):
+        raise ValueError(message)
+
+    try:
+        env = ImmutableSandboxedEnvironment(trim_blocks=True, lstrip_blocks=True)
+        env.globals["raise_exception"] = raise_exception
+        text = env.from_string(source).render(
+            messages=[{"role": "user", "content": _SENTINEL}],
+            add_generation_prompt=True,
+            bos_token="",
+            eos_token="",
+        )
+    except Exception as e:
+        print(f"chat_template を描画できませんでした: {e}")
+        return None
+    if text.count(_SENTINEL) != 1:
+        return None
+    prefix, _, suffix = text.partition(_SENTINEL)
+    return prefix, suffix
+
 
 @dataclass
 class Chat_templates:
@@ -6,12 +68,53 @@ class Chat_templates:
         "qwen3-instruct":"<|im_start|>user\n{}<|im_end|>\n<|im_start|>assistant",
         "mistral":"[INST] {}[/INST]",
         "chatml":"<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n<|im_start|>user\n{}<|im_end|>\n<|im_start|>assistant",
-        "gemma-3":"<start_of_turn>user\n{}<end_of_turn>\n<start_of_turn>model\n"
+        "gemma-3":"<start_of_turn>user\n{}<end_of_turn>\n<start_of_turn>model\n",
+        "llama-3":"<|start_header_id|>user<|end_header_id|>\n\n{}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n",
     }
     temp_name={
         "oss_V":"mistral",
         "oss_M":"mistral",
         "oss_L":"mistral",
-        "oss_G":"gemma3",
+        "oss_G":"gemma-3",
         "oss_Q":"qwen3-instruct"
-    }
\ No newline at end of file
+    }
+    # gguf の chat_template を描画できないとき（jinja2 が無い等）に、含まれる特殊トークンで見分ける
+    markers=[
+        ("<start_of_turn>","gemma-3"),
+        ("<|start_header_id|>","llama-3"),
+        ("[INST]","mistral"),
+        ("<|im_start|>","qwen3-instruct"),
+    ]
+    default: str = "chatml"
+    _compiled: Dict[str, ChatTemplate] = field(default_factory=dict)
+
+    def __post_init__(self):
+        # 名前の対応表の誤り（存在しないテンプレート名）は起動時に分かるようにする
+        for key, name in self.temp_name.items():
+            if name not in self.templates:
+                raise KeyError(f"temp_name[{key!r}] のテンプレート {name!r} がありません")
+        self._compiled = {name: ChatTemplate.compile(name, fmt) for name, fmt in self.templates.items()}
+
+    def get(self, name: str) -> ChatTemplate:
+        return self._compiled[name]
+
+    def resolve(self, modelname: str, gguf_template: str = "") -> ChatTemplate:
+        """
+        モデルに合うテンプレートを決める（モデルを読み込んだときに1回だけ呼ぶ）。
+        1) gguf の tokenizer.chat_template を描画したもの
+        2) 1) が描画できなければ、その中の特殊トークンで登録済みのテンプレートを選ぶ
+        3) モデル名の規則（temp_name）
+        4) どれにも当たらなければ chatml（その旨を表示する）
+        """
+        if gguf_template:
+            rendered = render_jinja(gguf_template)
+            if rendered is not None:
+                return ChatTemplate("gguf", *rendered)
+            for marker, name in self.markers:
+                if marker in gguf_template:
+                    return self._compiled[name]
+        matched: List[str] = [self.temp_name[key] for key in self.temp_name if key in modelname]
+        if matched:
+            return self._compiled[matched[-1]]
+        print(f"{modelname} のチャットテンプレートが分からないため {self.default} を使います")
+        return self._compiled[self.default]
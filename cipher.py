@@ -3,7 +3,10 @@ from __future__ import annotations
 import os
 import base64
 import hashlib
-from dataclasses import dataclass
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 import json
 import time
 
@@ -16,25 +19,50 @@ class SimpleStringCipher:
     - 強度は“雰囲気”レベル（要件: ぱっと見で読めなければOK向け）
 
     形式:
-        token = base64url( b"SC1" + salt(16) + ciphertext )
+        SC1: token = base64url( b"SC1" + salt(16) + ciphertext )
+             トークンごとにsaltが違うので、復号のたびにPBKDF2が走る（読み込みのみ対応）
+        SC2: token = base64url( b"SC2" + salt(16) + nonce(16) + ciphertext )
+             saltはファイル単位で共通、nonceはエントリごと。
+             PBKDF2はsaltごとに1回だけ行い、結果をキャッシュする。
     """
     password: str
     iterations: int = 200_000  # PBKDF2の反復回数（少し重くなるが安全側）
     salt_len: int = 16
-    header: bytes = b"SC1"     # バージョン識別
+    nonce_len: int = 16
+    header: bytes = b"SC2"     # バージョン識別（書き込みは常にSC2）
+    legacy_header: bytes = b"SC1"
+    # salt -> 導出済み鍵。frozenでも中身の更新は可能
+    _key_cache: Dict[bytes, bytes] = field(default_factory=dict, init=False, repr=False, compare=False)
 
-    def encrypt(self, plaintext: str) -> str:
+    def encrypt(self, plaintext: str, salt: Optional[bytes] = None) -> str:
+        """
+        SC2形式で暗号化する。
+        同じファイルに書くトークンは同じsaltを渡すこと（復号時のKDFが1回で済む）。
+        """
         if not isinstance(plaintext, str):
             raise TypeError("plaintext must be str")
 
-        salt = os.urandom(self.salt_len)
+        if salt is None:
+            salt = os.urandom(self.salt_len)
+        elif len(salt) != self.salt_len:
+            raise ValueError(f"salt must be {self.salt_len} bytes")
+
+        nonce = os.urandom(self.nonce_len)
         data = plaintext.encode("utf-8")
-        key_stream = self._keystream(len(data), salt)
+        key_stream = self._keystream_v2(len(data), self.derive_key(salt), nonce)
 
         ct = bytes(b ^ k for b, k in zip(data, key_stream))
-        packed = self.header + salt + ct
+        packed = self.header + salt + nonce + ct
         return base64.urlsafe_b64encode(packed).decode("ascii")
 
+    def encrypt_many(self, plaintexts: Iterable[str], salt: Optional[bytes] = None) -> List[str]:
+        """
+        まとめて暗号化（salt共通、KDFは1回）
+        """
+        if salt is None:
+            salt = os.urandom(self.salt_len)
+        return [self.encrypt(p, salt) for p in plaintexts]
+
     def decrypt(self, token: str) -> str:
         if not isinstance(token, str):
             raise TypeError("token must be str")
@@ -44,16 +72,24 @@ class SimpleStringCipher:
         except Exception as e:
             raise ValueError("Invalid token (base64 decode failed)") from e
 
-        if len(packed) < len(self.header) + self.salt_len:
-            raise ValueError("Invalid token (too short)")
-
-        if packed[: len(self.header)] != self.header:
+        head = packed[: len(self.header)]
+        if head == self.header:
+            body_start = len(self.header) + self.salt_len + self.nonce_len
+            if len(packed) < body_start:
+                raise ValueError("Invalid token (too short)")
+            salt = packed[len(self.header) : len(self.header) + self.salt_len]
+            nonce = packed[len(self.header) + self.salt_len : body_start]
+            ct = packed[body_start:]
+            key_stream = self._keystream_v2(len(ct), self.derive_key(salt), nonce)
+        elif head == self.legacy_header:
+            if len(packed) < len(self.legacy_header) + self.salt_len:
+                raise ValueError("Invalid token (too short)")
+            salt = packed[len(self.legacy_header) : len(self.legacy_header) + self.salt_len]
+            ct = packed[len(self.legacy_header) + self.salt_len :]
+            key_stream = self._keystream(len(ct), salt)
+        else:
             raise ValueError("Invalid token (bad header/version)")
 
-        salt = packed[len(self.header) : len(self.header) + self.salt_len]
-        ct = packed[len(self.header) + self.salt_len :]
-
-        key_stream = self._keystream(len(ct), salt)
         data = bytes(b ^ k for b, k in zip(ct, key_stream))
 
         try:
@@ -62,9 +98,38 @@ class SimpleStringCipher:
             # パスワード違い・破損など
             raise ValueError("Decrypt failed (wrong password or corrupted token)") from e
 
+    def decrypt_many(self, tokens: Iterable[str]) -> List[str]:
+        """
+        まとめて復号。SC2ならsaltごとの鍵キャッシュが効くので、
+        1ファイル分ならKDFは1回で済む。
+        """
+        return [self.decrypt(t) for t in tokens]
+
+    def derive_key(self, salt: bytes) -> bytes:
+        """
+        SC2用の鍵導出。saltごとに1回だけPBKDF2を回してキャッシュする。
+        """
+        key = self._key_cache.get(salt)
+        if key is None:
+            key = hashlib.pbkdf2_hmac("sha256", self.password.encode("utf-8"), salt, self.iterations, dklen=32)
+            self._key_cache[salt] = key
+        return key
+
+    @staticmethod
+    def _keystream_v2(nbytes: int, key: bytes, nonce: bytes) -> bytes:
+        """
+        導出済みの鍵とエントリごとのnonceから、カウンタ付きSHA256で必要量まで伸ばす。
+        """
+        out = bytearray()
+        counter = 0
+        while len(out) < nbytes:
+            out.extend(hashlib.sha256(key + nonce + counter.to_bytes(4, "big")).digest())
+            counter += 1
+        return bytes(out[:nbytes])
+
     def _keystream(self, nbytes: int, salt: bytes) -> bytes:
         """
-        PBKDF2で“鍵の元”を作り、カウンタ付きSHA256で必要量まで伸ばす。
+        (SC1) PBKDF2で“鍵の元”を作り、カウンタ付きSHA256で必要量まで伸ばす。
         """
         password_bytes = self.password.encode("utf-8")
         seed = hashlib.pbkdf2_hmac("sha256", password_bytes, salt, self.iterations, dklen=32)
@@ -82,26 +147,113 @@ class SimpleStringCipher:
     def create_encrypt_json(self,datas:dict,dire="."):
         os.makedirs(dire,exist_ok=True)
         new_datas={}
+        salt=os.urandom(self.salt_len)  # ファイル単位で共通のsalt
         for item in datas.keys():
             if isinstance(datas[item],list):
-                value=[self.encrypt(it) if isinstance(it,str) else it for it in datas[item] ]
+                value=[self.encrypt(it,salt) if isinstance(it,str) else it for it in datas[item] ]
                 new_datas.setdefault(item,value)
         filename=f"{dire}/gscript{time.strftime('%Y%m%d-%H%M%S')}.json"
         with open(filename,mode="w",encoding="utf-8")as f:
             json.dump(new_datas,f,ensure_ascii=False)
         return filename
     
-    def load_encrypt_json(self,path:str):
+    def load_encrypt_json(self,path:str,lazy:bool=False,workers:Optional[int]=None):
+        """
+        lazy=True なら LazyDecryptDict を返し、値は初回アクセス時に復号する。
+        workers を指定すると、SC1トークンをプロセスプールで並列に復号してから返す。
+        """
         with open(path,mode="r",encoding="utf-8")as f:
             datas=json.load(f)
+            if lazy or workers:
+                lazy_datas=LazyDecryptDict(self,datas)
+                if workers:
+                    lazy_datas.decrypt_all(workers)
+                return lazy_datas if lazy else dict(lazy_datas)
             new_datas={}
             for item in datas.keys():
                 if isinstance(datas[item],list):
-                    value=[self.decrypt(it) if isinstance(it,str) else it for it in datas[item]]
+                    tokens=[it for it in datas[item] if isinstance(it,str)]
+                    plains=iter(self.decrypt_many(tokens))
+                    value=[next(plains) if isinstance(it,str) else it for it in datas[item]]
                     new_datas.setdefault(item,value)
             return new_datas
 
 
+def _decrypt_sc1(args: tuple) -> str:
+    """
+    プロセスプール用（picklableなトップレベル関数である必要がある）
+    """
+    password, iterations, token = args
+    return SimpleStringCipher(password, iterations=iterations).decrypt(token)
+
+
+class LazyDecryptDict(Mapping):
+    """
+    暗号化されたガタライズスクリプトを遅延復号するMapping。
+    - d[key] で初めてその語彙の候補を復号し、以後はメモ化した値を返す
+    - decrypt_all(workers) で残りを一括復号（SC1はPBKDF2がGILをほぼ握るのでプロセス並列）
+    """
+
+    def __init__(self, cipher: SimpleStringCipher, tokens: Dict[str, Any]):
+        self._cipher = cipher
+        self._tokens = {k: v for k, v in tokens.items() if isinstance(v, list)}
+        self._plain: Dict[str, list] = {}
+
+    def __getitem__(self, key: str) -> list:
+        value = self._plain.get(key)
+        if value is None:
+            raw = self._tokens[key]
+            plains = iter(self._cipher.decrypt_many([it for it in raw if isinstance(it, str)]))
+            value = [next(plains) if isinstance(it, str) else it for it in raw]
+            self._plain[key] = value
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._tokens)
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._tokens
+
+    def is_decrypted(self, key: str) -> bool:
+        return key in self._plain
+
+    def decrypt_all(self, workers: Optional[int] = None) -> None:
+        """
+        未復号の値をまとめて復号する。
+        SC2はsaltごとの鍵キャッシュで十分速いのでそのまま、SC1だけプロセスプールに投げる。
+        """
+        pending = [k for k in self._tokens if k not in self._plain]
+        legacy = self._cipher.legacy_header
+        sc1_tokens = []
+        for key in pending:
+            for it in self._tokens[key]:
+                if isinstance(it, str) and _token_header(it, len(legacy)) == legacy:
+                    sc1_tokens.append(it)
+
+        done: Dict[str, str] = {}
+        if sc1_tokens and workers != 1:
+            args = [(self._cipher.password, self._cipher.iterations, t) for t in sc1_tokens]
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                done = dict(zip(sc1_tokens, ex.map(_decrypt_sc1, args, chunksize=4)))
+
+        for key in pending:
+            self._plain[key] = [
+                (done[it] if it in done else self._cipher.decrypt(it)) if isinstance(it, str) else it
+                for it in self._tokens[key]
+            ]
+
+
+def _token_header(token: str, nbytes: int) -> bytes:
+    # base64は4文字で3バイトなので、先頭だけデコードしてヘッダを見る
+    try:
+        return base64.urlsafe_b64decode(token[:4].encode("ascii"))[:nbytes]
+    except Exception:
+        return b""
+
+
 if __name__ == "__main__":
     cipher = SimpleStringCipher("my-password")
 
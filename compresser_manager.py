@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import socket
+import threading
+import time
+from typing import Callable, Optional
+
+
+class CompresserManager:
+    """
+    AI圧縮用 koboldcpp（LFM2.5, port 5015）の起動をバックグラウンドで進めるための管理クラス。
+    - prewarm() でダウンロード〜起動〜待ち受け確認までを別スレッドで行う
+    - state で今どの段階かをUIに見せられる
+    - 生成側は is_ready() を見て、準備できていなければその回はシンプル圧縮に切り替える
+    """
+
+    STOPPED = "停止中"
+    DOWNLOADING = "ダウンロード中"
+    STARTING = "起動中"
+    READY = "準備完了"
+    FAILED = "起動失敗"
+
+    def __init__(self, launch: Callable[[str, Callable[[str], None]], str], is_alive: Callable[[], bool],
+                 host: str = "127.0.0.1", port: int = 5015, ready_timeout: float = 300):
+        self._launch = launch
+        self._is_alive = is_alive
+        self.host = host
+        self.port = port
+        self.ready_timeout = ready_timeout
+        self.state = self.STOPPED
+        self.message = ""
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def prewarm(self, exepath: str) -> str:
+        """
+        まだ起動していなければバックグラウンドで起動を始める（すぐ戻る）
+        """
+        with self._lock:
+            if self.is_busy() or (self.state == self.READY and self._is_alive()):
+                return self.state
+            self.state = self.STARTING
+            self.message = ""
+            self._thread = threading.Thread(target=self._run, args=(exepath,), daemon=True)
+            self._thread.start()
+            return self.state
+
+    def is_busy(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def is_ready(self) -> bool:
+        if self.state != self.READY:
+            return False
+        if not self._is_alive():
+            self.state = self.STOPPED
+            return False
+        return True
+
+    def wait_ready(self, timeout: float) -> bool:
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        return self.is_ready()
+
+    def mark_stopped(self) -> None:
+        # 起動処理の途中なら、その結果を優先する
+        if not self.is_busy():
+            self.state = self.STOPPED
+
+    def status_text(self) -> str:
+        return f"AI圧縮: {self.state}" + (f"（{self.message}）" if self.message else "")
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+
+    def _run(self, exepath: str) -> None:
+        try:
+            msg = self._launch(exepath, self._set_state)
+            if msg not in ("起動完了", "すでに起動しています。"):
+                self.message = msg
+                self.state = self.FAILED
+                return
+            self.state = self.STARTING
+            deadline = time.time() + self.ready_timeout
+            while time.time() < deadline:
+                if not self._is_alive():
+                    self.message = "プロセスが終了しました"
+                    self.state = self.FAILED
+                    return
+                if self._is_listening():
+                    self.state = self.READY
+                    return
+                time.sleep(0.5)
+            self.message = "待ち受けを確認できませんでした"
+            self.state = self.FAILED
+        except Exception as e:
+            self.message = str(e)
+            self.state = self.FAILED
+
+    def _is_listening(self, timeout: float = 0.3) -> bool:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            return s.connect_ex((self.host, self.port)) == 0
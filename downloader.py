@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+
+@dataclass
+class DownloadProgress:
+    """
+    ダウンロードの進捗。UIはこれを一定間隔で見に来る。
+    """
+    url: str
+    path: str
+    total: int = 0          # 0: 不明
+    done: int = 0
+    state: str = "待機中"    # 待機中 / ダウンロード中 / 検証中 / 完了 / 失敗
+    error: str = ""
+    started: float = field(default_factory=time.time)
+    _resumed_from: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add(self, nbytes: int) -> None:
+        with self._lock:
+            self.done += nbytes
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ("完了", "失敗")
+
+    @property
+    def speed(self) -> float:
+        """今回の起動で落とした分の bytes/sec（再開前の分は含めない）"""
+        elapsed = time.time() - self.started
+        return (self.done - self._resumed_from) / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        speed = self.speed
+        if not self.total or speed <= 0:
+            return None
+        return max(self.total - self.done, 0) / speed
+
+    def status_text(self) -> str:
+        if self.state == "失敗":
+            return f"ダウンロード失敗: {self.error}"
+        if self.state in ("完了", "検証中"):
+            return "ダウンロード済み" if self.state == "完了" else "ダウンロード済み（検証中）"
+        mb = 1024 * 1024
+        text = f"ダウンロード中 {self.done / mb:.0f}MB"
+        if self.total:
+            text += f" / {self.total / mb:.0f}MB ({self.done / self.total:.0%})"
+        text += f"  {self.speed / mb:.1f}MB/s"
+        eta = self.eta
+        if eta is not None:
+            text += f"  残り {int(eta) // 60}:{int(eta) % 60:02d}"
+        return text
+
+
+class DownloadManager:
+    """
+    モデル(gguf)のダウンロード管理。
+    - .part に書き込み、中断しても次回は HTTP Range で続きから再開する
+    - サイズが大きくサーバが Range に対応していれば、範囲を分けて並列にダウンロードする
+      （各範囲の進み具合は .part.json に保存するので、並列でも再開できる）
+    - models/llm.json に size / sha256 があれば完了時に検証する
+    - 進捗は progress(path) で取得する
+    """
+
+    def __init__(self, connections: int = 4, min_split_size: int = 256 * 1024 * 1024,
+                 chunk_size: int = 1024 * 1024, timeout: Tuple[float, float] = (10, 60)):
+        self.connections = max(1, connections)
+        self.min_split_size = min_split_size
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._jobs: Dict[str, DownloadProgress] = {}
+        self._lock = threading.Lock()
+
+    def start(self, url: str, path: str, size: Optional[int] = None, sha256: Optional[str] = None) -> DownloadProgress:
+        """
+        バックグラウンドでダウンロードを始める（同じ path が進行中ならそれを返す）
+        """
+        with self._lock:
+            job = self._jobs.get(path)
+            if job is not None and not job.finished:
+                return job
+            job = DownloadProgress(url=url, path=path)
+            self._jobs[path] = job
+        threading.Thread(target=self._run, args=(job, size, sha256), daemon=True).start()
+        return job
+
+    def download(self, url: str, path: str, size: Optional[int] = None, sha256: Optional[str] = None) -> DownloadProgress:
+        """
+        同期版（呼び出し元のスレッドで完了まで待つ）
+        """
+        with self._lock:
+            job = DownloadProgress(url=url, path=path)
+            self._jobs[path] = job
+        self._run(job, size, sha256)
+        if job.state == "失敗":
+            raise RuntimeError(job.error)
+        return job
+
+    def progress(self, path: str) -> Optional[DownloadProgress]:
+        return self._jobs.get(path)
+
+    # ---- internals ----
+    def _run(self, job: DownloadProgress, size: Optional[int], sha256: Optional[str]) -> None:
+        part = job.path.replace(".gguf", ".part") if job.path.endswith(".gguf") else job.path + ".part"
+        try:
+            job.state = "ダウンロード中"
+            total, ranges_ok = self._probe(job.url)
+            if size and total and size != total:
+                raise RuntimeError(f"サイズがllm.jsonと一致しません ({total} != {size})")
+            job.total = total or (size or 0)
+            if ranges_ok and total >= self.min_split_size and self.connections > 1:
+                self._download_split(job, part, total)
+            else:
+                self._download_single(job, part, ranges_ok)
+
+            job.state = "検証中"
+            self._verify(part, size or job.total, sha256)
+            os.replace(part, job.path)
+            self._discard(part)  # 再開用の情報
+            job.state = "完了"
+        except Exception as e:
+            job.error = str(e)
+            job.state = "失敗"
+
+    def _probe(self, url: str) -> Tuple[int, bool]:
+        """
+        全体サイズと Range 対応かどうかを調べる（1バイトだけ要求する）
+        """
+        try:
+            with self.session.get(url, headers={"Range": "bytes=0-0"}, stream=True,
+                                  timeout=self.timeout, allow_redirects=True) as r:
+                if r.status_code == 206:
+                    content_range = r.headers.get("Content-Range", "")
+                    if "/" in content_range and content_range.rsplit("/", 1)[1].isdigit():
+                        return int(content_range.rsplit("/", 1)[1]), True
+                    return 0, True
+                r.raise_for_status()
+                return int(r.headers.get("Content-Length", 0) or 0), False
+        except requests.RequestException:
+            return 0, False
+
+    def _download_single(self, job: DownloadProgress, part: str, ranges_ok: bool) -> None:
+        offset = os.path.getsize(part) if (ranges_ok and os.path.exists(part)) else 0
+        if job.total and offset > job.total:
+            offset = 0
+        if job.total and offset == job.total:
+            job.done = job._resumed_from = offset
+            return
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self.session.get(job.url, headers=headers, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            if offset and r.status_code != 206:
+                offset = 0  # 再開できないサーバなので最初から
+            job.done = job._resumed_from = offset
+            job.started = time.time()
+            with open(part, "ab" if offset else "wb") as f:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    if chunk:
+                        f.write(chunk)
+                        job.add(len(chunk))
+
+    def _download_split(self, job: DownloadProgress, part: str, total: int) -> None:
+        meta_path = part + ".json"
+        step = -(-total // self.connections)
+        ranges: List[List[int]] = [[start, min(start + step, total) - 1, 0] for start in range(0, total, step)]
+        # 前回の途中経過があれば引き継ぐ（全体サイズが同じ場合だけ）
+        if os.path.exists(part) and os.path.exists(meta_path):
+            try:
+                with open(meta_path, mode="r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                if meta.get("total") == total:
+                    ranges = meta["ranges"]
+            except (OSError, ValueError, KeyError):
+                pass
+        if not os.path.exists(part) or os.path.getsize(part) != total:
+            with open(part, "wb") as f:
+                f.truncate(total)
+            for r in ranges:
+                r[2] = 0
+
+        job.done = job._resumed_from = sum(r[2] for r in ranges)
+        job.started = time.time()
+        meta_lock = threading.Lock()
+
+        def save_meta() -> None:
+            with meta_lock:
+                with open(meta_path, mode="w", encoding="utf-8") as f:
+                    json.dump({"total": total, "ranges": ranges}, f)
+
+        def fetch(rng: List[int]) -> None:
+            start, end, done = rng
+            if start + done > end:
+                return
+            headers = {"Range": f"bytes={start + done}-{end}"}
+            with self.session.get(job.url, headers=headers, stream=True, timeout=self.timeout) as r:
+                if r.status_code != 206:
+                    raise RuntimeError(f"Range要求に失敗しました (status {r.status_code})")
+                with open(part, "r+b") as f:
+                    f.seek(start + done)
+                    last_saved = time.time()
+                    try:
+                        for chunk in r.iter_content(chunk_size=self.chunk_size):
+                            if not chunk:
+                                continue
+                            f.write(chunk)
+                            rng[2] += len(chunk)
+                            job.add(len(chunk))
+                            if time.time() - last_saved > 1:
+                                f.flush()
+                                save_meta()
+                                last_saved = time.time()
+                    finally:
+                        # 途中で切れても、書けたところまでは次回に引き継ぐ
+                        f.flush()
+                        save_meta()
+
+        save_meta()
+        with ThreadPoolExecutor(max_workers=len(ranges)) as ex:
+            for _ in ex.map(fetch, ranges):
+                pass
+
+    def _verify(self, part: str, size: int, sha256: Optional[str]) -> None:
+        actual = os.path.getsize(part)
+        if size and actual != size:
+            self._discard(part)
+            raise RuntimeError(f"サイズが一致しません（{actual} != {size}、ファイルを削除しました）")
+        if sha256:
+            h = hashlib.sha256()
+            with open(part, "rb") as f:
+                for block in iter(lambda: f.read(self.chunk_size * 8), b""):
+                    h.update(block)
+            if h.hexdigest().lower() != sha256.lower():
+                self._discard(part)
+                raise RuntimeError("sha256が一致しません（ファイルを削除しました）")
+
+    @staticmethod
+    def _discard(part: str) -> None:
+        """
+        途中のファイルと再開用の情報を消す（残すと次回、合わない範囲情報から再開してしまう）
+        """
+        for path in (part, part + ".json"):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,325 @@
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import struct
+import threading
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from token_cache import write_json_atomic
+
+# gguf のメタデータ（キーと値）だけを読む。テンソル本体は読まない。
+# 形式: https://github.com/ggml-org/ggml/blob/master/docs/gguf.md
+
+GGUF_MAGIC = b"GGUF"
+
+_UINT8, _INT8, _UINT16, _INT16, _UINT32, _INT32, _FLOAT32, _BOOL, _STRING, _ARRAY, _UINT64, _INT64, _FLOAT64 = range(13)
+
+# load_arrays=False でも読む数値配列の大きさ（層ごとの head_count_kv など）
+_SMALL_ARRAY = 4096
+
+# 型番号 -> (struct の形式, バイト数)
+_SCALARS: Dict[int, Tuple[str, int]] = {
+    _UINT8: ("B", 1), _INT8: ("b", 1), _UINT16: ("H", 2), _INT16: ("h", 2),
+    _UINT32: ("I", 4), _INT32: ("i", 4), _FLOAT32: ("f", 4), _BOOL: ("?", 1),
+    _UINT64: ("Q", 8), _INT64: ("q", 8), _FLOAT64: ("d", 8),
+}
+
+
+class GGUFError(Exception):
+    """gguf として読めない"""
+
+
+@dataclass(frozen=True)
+class GGUFArray:
+    """
+    読み飛ばした配列（load_arrays=False のとき）。要素数と型だけ持つ。
+    """
+    item_type: int
+    count: int
+
+
+class _Reader:
+    def __init__(self, buf: mmap.mmap):
+        self.buf = buf
+        self.pos = 0
+
+    def scalar(self, fmt: str, size: int) -> Any:
+        if self.pos + size > len(self.buf):
+            raise GGUFError("unexpected end of file")
+        value = struct.unpack_from("<" + fmt, self.buf, self.pos)[0]
+        self.pos += size
+        return value
+
+    def string(self) -> str:
+        n = self.scalar("Q", 8)
+        end = self.pos + n
+        if end > len(self.buf):
+            raise GGUFError("unexpected end of file")
+        value = self.buf[self.pos:end].decode("utf-8", errors="replace")
+        self.pos = end
+        return value
+
+    def skip_string(self) -> None:
+        n = self.scalar("Q", 8)
+        self.pos += n
+
+    def value(self, vtype: int, load_arrays: bool) -> Any:
+        if vtype in _SCALARS:
+            return self.scalar(*_SCALARS[vtype])
+        if vtype == _STRING:
+            return self.string()
+        if vtype == _ARRAY:
+            item_type = self.scalar("I", 4)
+            count = self.scalar("Q", 8)
+            return self.array(item_type, count, load_arrays)
+        raise GGUFError(f"unknown value type {vtype}")
+
+    def array(self, item_type: int, count: int, load: bool) -> Any:
+        if item_type in _SCALARS:
+            fmt, size = _SCALARS[item_type]
+            end = self.pos + size * count
+            if end > len(self.buf):
+                raise GGUFError("unexpected end of file")
+            if not load and count > _SMALL_ARRAY:
+                self.pos = end
+                return GGUFArray(item_type, count)
+            # 数値の配列はまとめて変換する（scores などは語彙数ぶんある）
+            values = list(struct.unpack_from(f"<{count}{fmt}", self.buf, self.pos))
+            self.pos = end
+            return values
+        if item_type == _STRING:
+            if not load:
+                for _ in range(count):
+                    self.skip_string()
+                return GGUFArray(item_type, count)
+            return [self.string() for _ in range(count)]
+        # 配列の配列（実際にはほぼ使われない）
+        values = [self.array(self.scalar("I", 4), self.scalar("Q", 8), load) for _ in range(count)]
+        return values if load else GGUFArray(item_type, count)
+
+
+@dataclass(frozen=True)
+class GGUFTensor:
+    name: str
+    shape: Tuple[int, ...]
+    ggml_type: int
+    nbytes: int
+
+
+def read_metadata(path: str, load_arrays: bool = True) -> Dict[str, Any]:
+    """
+    gguf のメタデータを辞書で返す。ファイルは mmap で開くので、ヘッダ部分しか読み込まない。
+    load_arrays=False なら大きな配列（語彙・merges など）は読み飛ばして GGUFArray にする。
+    """
+    return _read(path, load_arrays, False)[0]
+
+
+def read_tensors(path: str) -> Tuple[Dict[str, Any], List[GGUFTensor]]:
+    """
+    メタデータ（配列は読み飛ばす）とテンソルの一覧を返す。テンソルの大きさはデータの位置の差から求めるので、
+    量子化の種類ごとのブロックの大きさを知らなくてよい。
+    """
+    return _read(path, False, True)
+
+
+def _read(path: str, load_arrays: bool, tensors: bool) -> Tuple[Dict[str, Any], List[GGUFTensor]]:
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < 4:
+            raise GGUFError(f"{path} は gguf ではありません")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if buf[:4] != GGUF_MAGIC:
+                raise GGUFError(f"{path} は gguf ではありません")
+            r = _Reader(buf)
+            r.pos = 4
+            version = r.scalar("I", 4)
+            if version < 2:
+                raise GGUFError(f"gguf v{version} には対応していません")
+            tensor_count = r.scalar("Q", 8)
+            kv_count = r.scalar("Q", 8)
+            datas: Dict[str, Any] = {"GGUF.version": version, "GGUF.tensor_count": tensor_count}
+            for _ in range(kv_count):
+                key = r.string()
+                vtype = r.scalar("I", 4)
+                datas[key] = r.value(vtype, load_arrays)
+            if not tensors:
+                return datas, []
+            infos = []
+            for _ in range(tensor_count):
+                name = r.string()
+                n_dims = r.scalar("I", 4)
+                shape = tuple(r.scalar("Q", 8) for _ in range(n_dims))
+                infos.append((name, shape, r.scalar("I", 4), r.scalar("Q", 8)))
+            alignment = datas.get("general.alignment", 32)
+            alignment = alignment if isinstance(alignment, int) and alignment > 0 else 32
+            data_start = (r.pos + alignment - 1) // alignment * alignment
+            ends = sorted(offset for *_, offset in infos)[1:] + [len(buf) - data_start]
+            next_offset = dict(zip(sorted(offset for *_, offset in infos), ends))
+            return datas, [GGUFTensor(name, shape, ggml_type, max(0, next_offset[offset] - offset))
+                           for name, shape, ggml_type, offset in infos]
+
+
+@dataclass(frozen=True)
+class GGUFInfo:
+    """
+    モデル選択・起動設定に使う gguf の情報
+    """
+    path: str
+    size: int
+    mtime: int                  # st_mtime_ns（size と合わせてキャッシュの有効性の確認に使う）
+    architecture: str = ""
+    name: str = ""
+    block_count: int = 0        # Transformer の層数
+    context_length: int = 0     # 学習時のコンテキスト長（0: 不明）
+    chat_template: str = ""     # tokenizer.chat_template（Jinja）
+    # メモリの見積もり用（バイト数）
+    layer_bytes: Tuple[int, ...] = ()         # 層ごとの重み
+    output_bytes: int = 0                     # 出力層（--gpulayers が層数+1 のとき GPU に載る）
+    other_bytes: int = 0                      # 埋め込みなど、常に CPU 側に置かれる重み
+    kv_bytes_per_token: Tuple[int, ...] = ()  # 層ごとの1トークンあたりの KV キャッシュ（f16）
+    n_embd: int = 0
+    n_head: int = 0
+    n_vocab: int = 0
+
+    @property
+    def max_gpu_layer(self) -> int:
+        # koboldcpp の --gpulayers は出力層も1つと数える
+        return self.block_count + 1 if self.block_count else 0
+
+
+def read_info(path: str) -> GGUFInfo:
+    """
+    gguf のヘッダとテンソルの一覧から GGUFInfo を作る。語彙などの大きな配列は読み飛ばす。
+    """
+    st = os.stat(path)
+    meta, tensors = read_tensors(path)
+    arch = str(meta.get("general.architecture", ""))
+
+    def num(key: str) -> int:
+        value = meta.get(f"{arch}.{key}")
+        return int(value) if isinstance(value, (int, float)) else 0
+
+    n_layer = num("block_count")
+
+    def per_layer(key: str) -> List[int]:
+        # 層ごとに違うモデル（ハイブリッドなど）は配列で入っている
+        value = meta.get(f"{arch}.{key}")
+        if isinstance(value, list):
+            return [int(v) for v in value[:n_layer]] + [0] * (n_layer - len(value))
+        return [int(value)] * n_layer if isinstance(value, (int, float)) else [0] * n_layer
+
+    layer_bytes = [0] * n_layer
+    output_bytes = other_bytes = 0
+    for t in tensors:
+        if t.name.startswith("blk."):
+            index = t.name.split(".")[1]
+            if index.isdigit() and int(index) < n_layer:
+                layer_bytes[int(index)] += t.nbytes
+                continue
+        if t.name.startswith("output"):
+            output_bytes += t.nbytes
+        else:
+            other_bytes += t.nbytes
+
+    n_embd = num("embedding_length")
+    n_head = per_layer("attention.head_count")
+    n_head_kv = per_layer("attention.head_count_kv") if f"{arch}.attention.head_count_kv" in meta else n_head
+    kv = []
+    for h, h_kv in zip(n_head, n_head_kv):
+        k_dim = num("attention.key_length") or (n_embd // h if h else 0)
+        v_dim = num("attention.value_length") or (n_embd // h if h else 0)
+        kv.append(h_kv * (k_dim + v_dim) * 2)
+
+    template = meta.get("tokenizer.chat_template", "")
+    vocab = meta.get("tokenizer.ggml.tokens")
+    return GGUFInfo(
+        path=path,
+        size=st.st_size,
+        mtime=st.st_mtime_ns,
+        architecture=arch,
+        name=str(meta.get("general.name", "")),
+        block_count=num("block_count"),
+        context_length=num("context_length"),
+        chat_template=template if isinstance(template, str) else "",
+        layer_bytes=tuple(layer_bytes),
+        output_bytes=output_bytes,
+        other_bytes=other_bytes,
+        kv_bytes_per_token=tuple(kv),
+        n_embd=n_embd,
+        n_head=max(n_head, default=0),
+        n_vocab=vocab.count if isinstance(vocab, GGUFArray) else len(vocab or []),
+    )
+
+
+_CACHE_VERSION = 2
+
+
+class GGUFInfoCache:
+    """
+    GGUFInfo のキャッシュ。ファイルのサイズと更新時刻が同じ間は読み直さない。
+    path を渡すとJSONに保存し、起動のたびにすべてのモデルのヘッダを読まずに済ませる。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._data: Dict[str, GGUFInfo] = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        if path:
+            self.load()
+
+    def get(self, path: str) -> Optional[GGUFInfo]:
+        """
+        読めなければ None（ダウンロード途中・gguf ではない等）
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = os.path.abspath(path)
+        with self._lock:
+            info = self._data.get(key)
+        if info is not None and info.size == st.st_size and info.mtime == st.st_mtime_ns:
+            return info
+        try:
+            info = read_info(path)
+        except (OSError, ValueError, GGUFError) as e:
+            print(f"gguf を読めませんでした: {path}: {e}")
+            return None
+        with self._lock:
+            self._data[key] = info
+            self._dirty = True
+        return info
+
+    # ---- disk store ----
+    def load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, mode="r", encoding="utf-8") as f:
+                datas = json.load(f)
+            if datas.get("version") != _CACHE_VERSION:
+                return  # 項目が変わった古いキャッシュは読み直す
+            infos = {}
+            for key, value in datas.get("models", {}).items():
+                value.update(layer_bytes=tuple(value["layer_bytes"]), kv_bytes_per_token=tuple(value["kv_bytes_per_token"]))
+                infos[key] = GGUFInfo(**value)
+        except (OSError, ValueError, TypeError, KeyError):
+            return  # 壊れていたら無視して作り直す
+        with self._lock:
+            self._data.update(infos)
+            self._dirty = False
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                models = {key: asdict(info) for key, info in self._data.items()}
+                self._dirty = False
+            write_json_atomic(self.path, {"version": _CACHE_VERSION, "models": models})
@@ -9,7 +9,8 @@ class Gscript_editer:
 
     def load_gsc(self,path:str):
         if os.path.exists(path) and path.endswith(".json"):
-            self.loaded=self.ssc.load_encrypt_json(path)
+            # 編集には全語彙が必要なので、SC1はプロセス並列でまとめて復号する
+            self.loaded=self.ssc.load_encrypt_json(path,workers=os.cpu_count())
             return self.loaded
         else:
             self.loaded={}
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+from typing import Any, Dict, List, Optional, Tuple
+
+# (先頭の一致文字数, 末尾の一致文字数, 間に入る文字列)
+# 上の状態 x から下の状態 y を x[:p] + mid + x[len(x)-s:] で作る
+Delta = Tuple[int, int, str]
+
+
+def _common_prefix(a: str, b: str, limit: int) -> int:
+    n = 0
+    step = 4096
+    while n < limit:
+        end = min(n + step, limit)
+        if a[n:end] == b[n:end]:
+            n = end
+            continue
+        while n < end and a[n] == b[n]:
+            n += 1
+        break
+    return n
+
+
+def _common_suffix(a: str, b: str, limit: int) -> int:
+    n = 0
+    step = 4096
+    la, lb = len(a), len(b)
+    while n < limit:
+        end = min(n + step, limit)
+        if a[la - end:la - n] == b[lb - end:lb - n]:
+            n = end
+            continue
+        while n < end and a[la - n - 1] == b[lb - n - 1]:
+            n += 1
+        break
+    return n
+
+
+def make_delta(src: str, dst: str) -> Delta:
+    """
+    src から dst を作る差分。大きく書き換えた場合は全文（チェックポイント）になる。
+    """
+    limit = min(len(src), len(dst))
+    p = _common_prefix(src, dst, limit)
+    s = _common_suffix(src, dst, limit - p)
+    mid = dst[p:len(dst) - s]
+    if len(mid) * 2 > len(dst):
+        return (0, 0, dst)
+    return (p, s, mid)
+
+
+def apply_delta(src: str, delta: Delta) -> str:
+    p, s, mid = delta
+    return src[:p] + mid + src[len(src) - s:]
+
+
+class DeltaStack:
+    """
+    文字列のスタック。一番上だけ全文で持ち、その下は「1つ上からの差分」で持つ。
+    リトライのたびに本文全体を積んでも、増えるのは追記された分だけになる。
+    """
+
+    def __init__(self):
+        self.top: Optional[str] = None
+        self.deltas: List[Delta] = []
+
+    def __len__(self) -> int:
+        return 0 if self.top is None else len(self.deltas) + 1
+
+    def push(self, text: str) -> None:
+        if self.top is not None:
+            self.deltas.append(make_delta(text, self.top))
+        self.top = text
+
+    def pop(self) -> str:
+        if self.top is None:
+            raise IndexError("pop from empty DeltaStack")
+        text = self.top
+        self.top = apply_delta(text, self.deltas.pop()) if self.deltas else None
+        return text
+
+    def clear(self) -> None:
+        self.top = None
+        self.deltas = []
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"top": self.top, "deltas": [list(d) for d in self.deltas]}
+
+    @classmethod
+    def from_dict(cls, datas: Any) -> "DeltaStack":
+        stack = cls()
+        if isinstance(datas, list):
+            # 旧形式（全文のリスト。末尾が一番上）
+            for text in datas:
+                stack.push(text)
+            return stack
+        if datas and datas.get("top") is not None:
+            stack.top = datas["top"]
+            stack.deltas = [(int(p), int(s), str(mid)) for p, s, mid in datas.get("deltas", [])]
+        return stack
+
+
+class TextHistory:
+    """
+    本文の undo/redo 履歴。push は生成前・編集前の本文を積み、undo/redo は今の本文と入れ替える。
+    - 積むたびに全文をコピーしない（DeltaStack）
+    - to_dict()/from_dict() で export_json 用の小さな形にする（旧形式の undo/redo リストも読める）
+    """
+
+    def __init__(self):
+        self.undo_stack = DeltaStack()
+        self.redo_stack = DeltaStack()
+
+    def push(self, text: str) -> None:
+        self.undo_stack.push(text)
+        self.redo_stack.clear()
+
+    def undo(self, current: str) -> str:
+        if not len(self.undo_stack):
+            return current
+        prev = self.undo_stack.pop()
+        self.redo_stack.push(current)
+        return prev
+
+    def redo(self, current: str) -> str:
+        if not len(self.redo_stack):
+            return current
+        nxt = self.redo_stack.pop()
+        self.undo_stack.push(current)
+        return nxt
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"version": 2, "undo": self.undo_stack.to_dict(), "redo": self.redo_stack.to_dict()}
+
+    @classmethod
+    def from_dict(cls, datas: Optional[Dict[str, Any]]) -> "TextHistory":
+        history = cls()
+        if datas:
+            history.undo_stack = DeltaStack.from_dict(datas.get("undo"))
+            history.redo_stack = DeltaStack.from_dict(datas.get("redo"))
+        return history
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+from typing import Any, Dict, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class KoboldHttpClient:
+    """
+    KoboldCpp へのHTTP呼び出し用の keep-alive クライアント。
+    - requests.Session + コネクションプールで、毎回TCP接続を張り直さない
+    - 接続失敗（リクエスト未送信）のときだけリトライする。generate は冪等でないので読み込み失敗では再送しない
+    - timeout は (接続, 読み込み) の組で、接続先ごとに別のクライアントを持つ
+    - stats() で接続の再利用状況を確認できる
+    """
+
+    def __init__(self, connect_timeout: float = 3.05, read_timeout: float = 180, retries: int = 2, pool_maxsize: int = 8):
+        self.timeout: Tuple[float, float] = (connect_timeout, read_timeout)
+        retry = Retry(total=retries, connect=retries, read=0, status=0, other=0,
+                      backoff_factor=0.1, allowed_methods=None, raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def request(self, method: str, url: str, timeout: Union[float, Tuple[float, float], None] = None, **kwargs: Any) -> requests.Response:
+        return self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        requests: 送ったリクエスト数 / connections: 新しく張ったTCP接続数 / reused: 使い回した回数
+        """
+        requests_sent = 0
+        connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_sent += pool.num_requests
+            connections += pool.num_connections
+        return {
+            "requests": requests_sent,
+            "connections": connections,
+            "reused": max(requests_sent - connections, 0),
+        }
+
+    def close(self) -> None:
+        self.session.close()
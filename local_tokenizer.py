@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import heapq
+import re
+import sys
+import threading
+import unicodedata
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from gguf_reader import read_metadata
+
+# トークンの種類（gguf の tokenizer.ggml.token_type）
+_NORMAL, _UNKNOWN, _CONTROL, _USER_DEFINED, _UNUSED, _BYTE = range(1, 7)
+
+# サーバとの照合に使う文章（日本語・英語・改行・記号・テンプレートのトークン）
+VERIFY_SAMPLES = [
+    "吾輩は猫である。名前はまだ無い。",
+    "どこで生れたかとんと見当がつかぬ。\n何でも薄暗いじめじめした所でニャーニャー泣いていた事だけは記憶している。",
+    "The quick brown fox jumps over the lazy dog. It's 2024, isn't it?",
+    "「おはよう」と彼女は言った。\n\n　――そして、３年後。ＡＢＣ①②",
+    "  indented   text\twith\ttabs and 1234567 numbers...\n\n\n",
+    "<|im_start|>user\nこんにちは<|im_end|>\n<|im_start|>assistant",
+    "[INST] 続きを書いてください。[/INST]",
+]
+
+
+@lru_cache(maxsize=None)
+def _category_ranges(prefixes: Tuple[str, ...]) -> str:
+    """
+    Unicode カテゴリが prefixes のどれかで始まる文字を、正規表現の文字クラスの中身（範囲の並び）にする。
+    標準の re には \\p{L} が無いので、その代わりに使う。
+    """
+    ranges: List[Tuple[int, int]] = []
+    start = -1
+    for cp in range(sys.maxunicode + 1):
+        hit = unicodedata.category(chr(cp)).startswith(prefixes)
+        if hit and start < 0:
+            start = cp
+        elif not hit and start >= 0:
+            ranges.append((start, cp - 1))
+            start = -1
+    if start >= 0:
+        ranges.append((start, sys.maxunicode))
+    return "".join(f"\\U{a:08x}" if a == b else f"\\U{a:08x}-\\U{b:08x}" for a, b in ranges)
+
+
+def _pre_tokenizer(pre: str) -> "re.Pattern[str]":
+    """
+    llama.cpp の BPE の前処理（tokenizer.ggml.pre ごとの分割規則）。{L} は文字、{N} は数字。
+    """
+    contractions = r"(?:'[sS]|'[tT]|'[rR][eE]|'[vV][eE]|'[mM]|'[lL][lL]|'[dD])"
+    # 大文字/小文字を区別する分割（tekken / gpt-4o）
+    upper_lower = r"[^\r\n{L}{N}]?(?:(?=[{L}])[^a-z])*(?:(?=[{L}])[^A-Z])+"
+    lower_upper = r"[^\r\n{L}{N}]?(?:(?=[{L}])[^a-z])+(?:(?=[{L}])[^A-Z])*"
+    patterns = {
+        "llama3": contractions + r"|[^\r\n{L}{N}]?[{L}]+|[{N}]{{1,3}}| ?[^\s{L}{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+",
+        "qwen2": contractions + r"|[^\r\n{L}{N}]?[{L}]+|[{N}]| ?[^\s{L}{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+",
+        "tekken": upper_lower + "|" + lower_upper + r"|[{N}]| ?[^\s{L}{N}]+[\r\n/]*|\s*[\r\n]+|\s+(?!\S)|\s+",
+        "gpt-4o": upper_lower + contractions + "?|" + lower_upper + contractions + r"?|[{N}]{{1,3}}| ?[^\s{L}{N}]+[\r\n/]*|\s*[\r\n]+|\s+(?!\S)|\s+",
+        "default": r"'s|'t|'re|'ve|'m|'ll|'d| ?[{L}]+| ?[{N}]+| ?[^\s{L}{N}]+|\s+(?!\S)|\s+",
+    }
+    aliases = {"llama-bpe": "llama3", "llama-v3": "llama3", "falcon3": "llama3", "pixtral": "llama3",
+               "deepseek-r1-qwen": "qwen2", "qwen35": "qwen2"}
+    pattern = patterns.get(aliases.get(pre, pre), patterns["default"])
+    return re.compile(pattern.format(L=_category_ranges(("L",)), N=_category_ranges(("N",))))
+
+
+@lru_cache(maxsize=1)
+def _byte_encoder() -> Dict[int, str]:
+    """GPT-2 のバイト -> 表示用文字の対応"""
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return {b: chr(c) for b, c in zip(bs, cs)}
+
+
+class LocalTokenizer:
+    """
+    gguf に入っている語彙でトークン数を数える（koboldcpp に問い合わせない）。
+    - SentencePiece 系（tokenizer.ggml.model = "llama"）と、バイト単位 BPE 系（"gpt2"）に対応
+    - テンプレートの特殊トークンは1トークンとして数える
+    - verify() でサーバの数と照合し、差が一定（BOS の有無など）ならその差を補正して使う。
+      一致しなければ verified=False になり、呼び出し側はサーバで数える
+    """
+
+    def __init__(self, name: str, model: str, tokens: List[str], token_types: List[int], scores: List[float],
+                 merges: List[str], pre: str = "default", add_space_prefix: bool = True):
+        self.name = name
+        self.model = model
+        self.vocab: Dict[str, int] = {t: i for i, t in enumerate(tokens)}
+        self.scores = scores
+        self.add_space_prefix = add_space_prefix
+        self.offset = 0                          # サーバの数 - ローカルの数
+        self.verified: Optional[bool] = None     # None: 未照合
+        specials = [t for t, ty in zip(tokens, token_types) if ty in (_CONTROL, _USER_DEFINED, _UNKNOWN) and t]
+        specials.sort(key=len, reverse=True)
+        self._special = re.compile("|".join(map(re.escape, specials))) if specials else None
+        self._ranks: Dict[Tuple[str, str], int] = {}
+        if model == "gpt2":
+            for rank, merge in enumerate(merges):
+                a, _, b = merge.partition(" ")
+                self._ranks[(a, b)] = rank
+            self._pre = _pre_tokenizer(pre)
+        self._bpe_cache: Dict[str, int] = {}
+
+    @classmethod
+    def from_gguf(cls, path: str) -> "LocalTokenizer":
+        meta = read_metadata(path)
+        model = str(meta.get("tokenizer.ggml.model", ""))
+        if model not in ("llama", "gpt2"):
+            raise ValueError(f"未対応のトークナイザです: {model or '不明'}")
+        tokens = meta["tokenizer.ggml.tokens"]
+        return cls(
+            name=path,
+            model=model,
+            tokens=tokens,
+            token_types=meta.get("tokenizer.ggml.token_type") or [_NORMAL] * len(tokens),
+            scores=meta.get("tokenizer.ggml.scores") or [0.0] * len(tokens),
+            merges=meta.get("tokenizer.ggml.merges") or [],
+            pre=str(meta.get("tokenizer.ggml.pre", "default")),
+            add_space_prefix=bool(meta.get("tokenizer.ggml.add_space_prefix", model == "llama")),
+        )
+
+    def count(self, text: str) -> int:
+        return self._count_raw(text) + self.offset
+
+    def verify(self, server_count: Callable[[str], int], samples: Iterable[str] = VERIFY_SAMPLES) -> bool:
+        """
+        サーバ（/api/extra/tokencount）の数と照合する。差がすべて同じならその差を offset にする。
+        """
+        diffs = {int(server_count(s)) - self._count_raw(s) for s in samples}
+        self.verified = len(diffs) == 1
+        self.offset = diffs.pop() if self.verified else 0
+        return self.verified
+
+    # ---- internals ----
+    def _count_raw(self, text: str) -> int:
+        n = 0
+        prev_special = True
+        pos = 0
+        if self._special is not None:
+            for m in self._special.finditer(text):
+                if m.start() > pos:
+                    n += self._count_fragment(text[pos:m.start()], prev_special)
+                n += 1
+                prev_special = True
+                pos = m.end()
+        if pos < len(text):
+            n += self._count_fragment(text[pos:], prev_special)
+        return n
+
+    def _count_fragment(self, text: str, prev_special: bool) -> int:
+        if self.model == "llama":
+            if self.add_space_prefix and prev_special:
+                text = " " + text
+            return self._spm(text.replace(" ", "▁"))
+        total = 0
+        for word in self._pre.findall(text):
+            total += self._bpe(word)
+        return total
+
+    def _spm(self, text: str) -> int:
+        """
+        llama.cpp の SPM と同じ手順: 隣り合う記号の組のうち、つなげた文字列が語彙にあって
+        スコアが一番高いものから順につなげる。語彙に無い1文字はバイト単位で数える。
+        """
+        if not text:
+            return 0
+        syms = list(text)
+        nbytes = [len(c.encode("utf-8")) for c in syms]
+        prev = list(range(-1, len(syms) - 1))
+        nxt = list(range(1, len(syms) + 1))
+        nxt[-1] = -1
+        heap: List[Tuple[float, int, int, int]] = []
+
+        def add(left: int, right: int) -> None:
+            if left < 0 or right < 0:
+                return
+            tid = self.vocab.get(syms[left] + syms[right])
+            if tid is not None:
+                heapq.heappush(heap, (-self.scores[tid], left, right, nbytes[left] + nbytes[right]))
+
+        for i in range(1, len(syms)):
+            add(i - 1, i)
+        while heap:
+            _, left, right, size = heapq.heappop(heap)
+            if not nbytes[left] or not nbytes[right] or nbytes[left] + nbytes[right] != size:
+                continue  # 古い組
+            syms[left] += syms[right]
+            nbytes[left] += nbytes[right]
+            syms[right] = ""
+            nbytes[right] = 0
+            nxt[left] = nxt[right]
+            if nxt[right] >= 0:
+                prev[nxt[right]] = left
+            add(prev[left], left)
+            add(left, nxt[left])
+        return sum(1 if s in self.vocab else len(s.encode("utf-8")) for s in syms if s)
+
+    def _bpe(self, word: str) -> int:
+        cached = self._bpe_cache.get(word)
+        if cached is not None:
+            return cached
+        enc = _byte_encoder()
+        parts = [enc[b] for b in word.encode("utf-8")]
+        ranks = self._ranks
+        while len(parts) > 1:
+            best = None
+            best_rank = None
+            for i in range(len(parts) - 1):
+                rank = ranks.get((parts[i], parts[i + 1]))
+                if rank is not None and (best_rank is None or rank < best_rank):
+                    best, best_rank = i, rank
+            if best is None:
+                break
+            a, b = parts[best], parts[best + 1]
+            merged: List[str] = []
+            i = 0
+            while i < len(parts):
+                if i < len(parts) - 1 and parts[i] == a and parts[i + 1] == b:
+                    merged.append(a + b)
+                    i += 2
+                else:
+                    merged.append(parts[i])
+                    i += 1
+            parts = merged
+        # 語彙に無いもの（普通は無い）は1バイトずつ数える
+        n = sum(1 if p in self.vocab else len(p) for p in parts)
+        if len(self._bpe_cache) > 100_000:
+            self._bpe_cache.clear()
+        self._bpe_cache[word] = n
+        return n
+
+
+class TokenizerSlot:
+    """
+    読み込んだ LocalTokenizer の置き場所。KoboldCppBackend の浅いコピー（_bind）からも
+    同じものを読み書きするように、属性ではなくこのオブジェクトを共有する。
+    """
+
+    def __init__(self):
+        self.tokenizer: Optional[LocalTokenizer] = None
+        self.loading = ""  # 読み込み中の gguf のパス
+        self._lock = threading.Lock()
+
+    def begin(self, path: str) -> bool:
+        """
+        path の読み込みを始めてよければ True（読み込み済み・読み込み中なら False）
+        """
+        with self._lock:
+            if (self.tokenizer is not None and self.tokenizer.name == path) or self.loading == path:
+                return False
+            self.loading = path
+            return True
+
+    def finish(self, path: str, tokenizer: Optional[LocalTokenizer]) -> None:
+        with self._lock:
+            if self.loading == path:
+                self.loading = ""
+            if tokenizer is not None:
+                self.tokenizer = tokenizer
@@ -1,58 +1,43 @@
 import time
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import os
 import threading
-import socket
 from backend import KoboldCppBackend,KoboldCppConfig
+from backend_pool import SessionState
 from gscript_edit import Gscript_editer
+from replacer import GscriptReplacer, StreamingReplacer
+from stream_filter import BracketStripper
+from history import TextHistory
 import git_controll as gic
 import json
 import signal
 import pathlib
 import sys
-import random
 import subprocess
 import re
 
 import gradio as gr
 
+MAX_CANDIDATES = 4  # 候補を並べて生成するときの最大数
 
 
 # =========================
 # UI helpers (undo/redo)
 # =========================
 
-def _push_history(text: str, undo_stack: List[str], redo_stack: List[str]) -> Tuple[List[str], List[str]]:
-    # undo_stack は「過去の状態」を積む。redo は新操作が入ったら消す。
-    undo_stack = list(undo_stack)
-    redo_stack = list(redo_stack)
-    undo_stack.append(text)
-    redo_stack.clear()
-    return undo_stack, redo_stack
+def _push_history(text: str, history: TextHistory) -> TextHistory:
+    # undo 側に「過去の状態」を積む。redo は新操作が入ったら消す。
+    # 全文ではなく差分で持つので、リストのコピーもしない
+    history.push(text)
+    return history
 
 
-def _undo(current: str, undo_stack: List[str], redo_stack: List[str]) -> Tuple[str, List[str], List[str]]:
-    undo_stack = list(undo_stack)
-    redo_stack = list(redo_stack)
+def _undo(current: str, history: TextHistory) -> Tuple[str, TextHistory]:
+    return history.undo(current), history
 
-    if not undo_stack:
-        return current, undo_stack, redo_stack
 
-    prev = undo_stack.pop()
-    redo_stack.append(current)
-    return prev, undo_stack, redo_stack
-
-
-def _redo(current: str, undo_stack: List[str], redo_stack: List[str]) -> Tuple[str, List[str], List[str]]:
-    undo_stack = list(undo_stack)
-    redo_stack = list(redo_stack)
-
-    if not redo_stack:
-        return current, undo_stack, redo_stack
-
-    nxt = redo_stack.pop()
-    undo_stack.append(current)
-    return nxt, undo_stack, redo_stack
+def _redo(current: str, history: TextHistory) -> Tuple[str, TextHistory]:
+    return history.redo(current), history
 
 
 def _build_prompt(title: str, genre: str, characters: str, background: str, additional: str, free_instr: str, current_text: str) -> str:
@@ -106,17 +91,25 @@ def _build_prompt(title: str, genre: str, characters: str, background: str, addi
 
 def build_ui() -> gr.Blocks:
     backend = KoboldCppBackend(KoboldCppConfig(base_url="http://127.0.0.1:5001"))
+
+    def _candidate_limits() -> dict:
+        # 候補を並べられるのは同時に生成できる接続先がある場合だけ（1つなら順番待ちで k 倍かかる）
+        capacity=backend.max_candidates()
+        if capacity<2:
+            return dict(interactive=False,info="base_url をカンマ区切りで複数指定すると、同じ続きを複数同時に生成して選べます。")
+        return dict(maximum=min(MAX_CANDIDATES,capacity),interactive=True,
+                    info=f"2以上にすると同じ続きを複数同時に生成し、良いものを選んで採用できます（最大 {min(MAX_CANDIDATES,capacity)}）。")
     gse=Gscript_editer()
 
     with gr.Blocks(title="Easy Novel Assistant osuChitsu") as demo:
         # undo/redo stacks
-        undo_stack = gr.State([])  # List[str]
-        redo_stack = gr.State([])  # List[str]
-        doc_state=gr.State("")
-        gscripts_state=gr.State(backend.gscript)
+        history = gr.State(TextHistory())  # undo/redo（差分で保持）
+        gscripts_state=gr.State(backend.replacer) #GscriptReplacer
         gsc_edit_state=gr.State({}) #dict
         gsc_edit_state_text=gr.State([]) #List[str]
         git_state=gr.State(False)
+        session_state=gr.State(SessionState()) #SessionState（タブごとのウィンドウ位置・直前のプロンプト・接続先）
+        warned_launch=gr.State(None) #メモリ不足の見込みを伝えた起動設定（同じ設定でもう一度押したら起動する）
 
         with gr.Row():
             gr.Markdown("# Easy Novel Assistant OsuChitsu")
@@ -135,8 +128,20 @@ def build_ui() -> gr.Blocks:
 
                 with gr.Row():
                     retry_btn = gr.Button("リトライ",variant="primary")
+                    cancel_btn = gr.Button("停止",variant="stop")
                     undo_btn = gr.Button("undo")
                     redo_btn = gr.Button("redo")
+                prompt_info = gr.Markdown("")
+                # 候補を並べて生成したときの表示（採用した候補を本文の後ろに足す）
+                with gr.Row(visible=False) as cand_row:
+                    cand_cols=[]
+                    cand_boxes=[]
+                    cand_btns=[]
+                    for i in range(MAX_CANDIDATES):
+                        with gr.Column(min_width=160) as col:
+                            cand_boxes.append(gr.Textbox(label=f"候補{i+1}",lines=12,max_lines=12,interactive=False))
+                            cand_btns.append(gr.Button("これを採用"))
+                        cand_cols.append(col)
 
             with gr.Column(scale=1):
                 with gr.Tabs():
@@ -159,7 +164,11 @@ def build_ui() -> gr.Blocks:
                         top_p = gr.Slider(0.01, 1.0, value=0.95, step=0.01, label="top_p", interactive=True,info="このパラメータが高いほどより多様な語彙を使用するようになります。")
                         repeat_penalty = gr.Slider(0, 2.0, value=1.1, step=0.1, label="repeat_penalty", interactive=True, info="このパラメータが高いほど同じ文章の繰り返しを抑制します。")                      
                         max_new_tokens = gr.Slider(64, 2048, value=512, step=32, label="max_new_tokens", interactive=True,info="1度に生成する文章量を決定します。")
-                        cut_mode=gr.Radio(["AI圧縮","シンプル"],label="context長圧縮方式",interactive=True,value="シンプル")
+                        n_candidates = gr.Slider(1, MAX_CANDIDATES, value=1, step=1, label="候補数", **_candidate_limits())
+                        cut_mode=gr.Radio(["AI圧縮","シンプル","ウィンドウ","階層要約"],label="context長圧縮方式",interactive=True,value="シンプル",
+                                          info="ウィンドウ: まとめて切って先頭を固定し、KoboldCppのキャッシュを再利用しやすくします。\n階層要約: 古い部分を章ごとの要約に置き換えます。長編向け。")
+                        comp_status=gr.Markdown("")
+                        comp_timer=gr.Timer(1.0,active=False)  # 圧縮用サーバの準備中だけ状態を更新する
                         
 
                     with gr.TabItem("KoboldCpp"):
@@ -184,15 +193,21 @@ def build_ui() -> gr.Blocks:
                             gr.Markdown("以下のパラメータは使用するPCのビデオメモリ、メインメモリを確認しながら調整してください<br>許容値を超えた場合、起動に失敗することがあります")
                             layers = gr.Slider(-1, 0, value=-1, step=1, label="layers",info="大きいほどGPUを重点的に使用します。\nビデオメモリが小さい場合は小さくしてください。\nCPU生成の場合は0にしてください。")
                         context_length = gr.Slider(2048, 20480, value=2048, step=2048, label="context_length", interactive=True,info="LLMが参照できる文章量を指定します。長編や設定の細かい作品では大きくしてください。\nビデオメモリが小さい場合は小さくしてください。")
+                        with gr.Row():
+                            vram_gb = gr.Number(0, label="ビデオメモリ(GB)", minimum=0, info="0 なら自動で調べます（NVIDIA のみ）。CPUで生成する場合も 0 のままで構いません。")
+                            recommend_btn = gr.Button("おすすめ設定",variant="secondary")
                         with gr.Row():
                             start_btn = gr.Button("起動",variant="primary")
                             stop_btn = gr.Button("終了",variant="stop")
+                            standby_btn = gr.Button("裏で起動",variant="secondary")
                         koboldcpp_exe = gr.Textbox(
                             label="koboldcpp 実行ファイルパス（起動する場合のみ）",
                             placeholder="例: ./koboldcpp  または  C:\\path\\koboldcpp.exe",
                             value="koboldcpp",
                         )
-                        base_url = gr.Textbox(label="base_url", value="http://127.0.0.1:5001", interactive=True)
+                        local_tokenizer = gr.Checkbox(label="ローカルでトークン数を数える", value=backend.config.local_tokenizer,
+                                                      info="モデルの gguf からトークナイザを読み、サーバに問い合わせずに数えます。サーバの数と一致した場合だけ使います。")
+                        base_url = gr.Textbox(label="base_url", value="http://127.0.0.1:5001", interactive=True,info="カンマ区切りで複数指定すると、生成を空いている方に振り分けます（先頭が起動/終了の対象）")
                         status = gr.Markdown("")
 
                     with gr.TabItem("保存/終了"):
@@ -225,7 +240,7 @@ def build_ui() -> gr.Blocks:
         # ---- events ----
         def reload_gscripts(path:str):
             backend.reload_gscript(path)
-            return backend.gscript
+            return backend.replacer
         original_file.upload(reload_gscripts,inputs=[original_file],outputs=[gscripts_state]).then(lambda x:gr.update(visible="hidden"),
                                                                                                 inputs=[original_file],outputs=[original_file])
 
@@ -235,30 +250,41 @@ def build_ui() -> gr.Blocks:
             else:
                 return gr.update(value=None,visible="hidden")
         
-        def switch_dict(bl:bool,current:dict):
+        def switch_dict(bl:bool,current:GscriptReplacer):
             if not bl:
                 backend.reload_gscript("gscript.json")
-                return backend.gscript
+                return backend.replacer
             else:
                 return current
         original_gscripts.input(switch_bool,inputs=[original_gscripts],outputs=[original_file]).then(switch_dict,inputs=[original_gscripts,gscripts_state],
                                                                                                     outputs=[gscripts_state])
 
-        def save_before(current_text: str):
-            if current_text is None or current_text =="":
-                return gr.State("")
-            return gr.State(current_text)
-        output_display.change(save_before,inputs=[output_display],outputs=[doc_state])
-
         def on_change_base_url(new_url: str):
-            backend.config.base_url = new_url
-            return f"base_url を {new_url} に設定しました。"
+            backend.set_base_url(new_url)
+            return f"base_url を {new_url} に設定しました。",gr.update(value=1,**_candidate_limits())
         
         def on_change_kobold_path(new_path: str):
             backend.config.kobold_path=new_path
             return None
 
-        base_url.change(on_change_base_url, inputs=[base_url], outputs=[status])
+        def on_change_cut_mode(mode: str, exe: str):
+            """
+            AI圧縮を使う方式が選ばれたら、圧縮用サーバの準備を裏で始める。
+            状態の表示は comp_timer で更新する（準備が終わるまでキューを占有しない）
+            """
+            if mode not in ("AI圧縮","階層要約"):
+                return "",gr.Timer(active=False)
+            backend.config.kobold_path=exe
+            backend.compresser.prewarm(exe)
+            return backend.compresser.status_text(),gr.Timer(active=True)
+
+        def on_comp_tick():
+            done=backend.compresser.state in (backend.compresser.READY,backend.compresser.FAILED)
+            return backend.compresser.status_text(),gr.Timer(active=not done)
+
+        cut_mode.change(on_change_cut_mode,inputs=[cut_mode,koboldcpp_exe],outputs=[comp_status,comp_timer])
+        comp_timer.tick(on_comp_tick,inputs=[],outputs=[comp_status,comp_timer])
+        base_url.change(on_change_base_url, inputs=[base_url], outputs=[status,n_candidates])
         koboldcpp_exe.change(on_change_kobold_path,inputs=[koboldcpp_exe],outputs=[])
 
         def on_retry_stream(
@@ -274,14 +300,16 @@ def build_ui() -> gr.Blocks:
             top_p: float,
             repeat_penalty: float,
             max_new_tokens: int,
-            before: str,
             replace:bool=False,
-            replacelist:dict={},
+            replacer:Optional[GscriptReplacer]=None,
             cut_mode: str="シンプル",
-            exepath="koboldcpp"
+            exepath="koboldcpp",
+            session:Optional[SessionState]=None,
+            n_candidates: int=1,
+            request: gr.Request=None
         ):
             # undo 用に、生成前を保存（redoはクリア）
-            #undo_stack, redo_stack = _push_history(current_text, undo_stack, redo_stack)
+            #history = _push_history(current_text, history)
         
             prompt = _build_prompt(title,genre,characters,background, additional, free_instr, current_text)
             header = _build_prompt(title,genre,characters,background, additional, free_instr, "")
@@ -295,39 +323,96 @@ def build_ui() -> gr.Blocks:
 
             def tail_ereaser(text: str,keyword: str):
                 return re.sub(keyword,"",text)
+
+            cancel_key=request.session_hash if request else ""
+            # 候補は同時に生成できる数まで（1つの koboldcpp では順番に処理されるだけなので並べない）
+            n_candidates=min(int(n_candidates),backend.max_candidates())
+            if n_candidates>1:
+                yield from _stream_candidates(prompt,params,header,current_text,cut_mode,exepath,max_new_tokens,
+                                              n_candidates,replace,replacer,session,cancel_key)
+                return
         
             base = current_text
-            acc = ""  # 生成済みを蓄積
+            chunks: List[str] = []  # 生成済みを蓄積（文字列の連結を繰り返さない）
+            # 【...】 は増分だけを見て取り除く（全文への re.sub を毎回しない）
+            brackets=BracketStripper()
+            # ガタライズは増分ごとに逐次適用（最後にまとめて書き換えない）
+            stream=StreamingReplacer(replacer) if replace and replacer else None
         
             try:
-                first=True
-                for delta in backend.generate_polled_stream(prompt, params,header,current_text,cut_mode,exepath,max_new_tokens):
-                    if first and base != "":
-                        first=False
-                        continue
-                    elif first and before != base and len(base)<1:
-                        first=False
-                        backend.not_first_gen=True
-                        continue
-                    acc += delta
-                    acc=tail_ereaser(acc,r'【.*?】')
-                    if "Over Max Tokens" in acc:
+                # 前回の生成結果の混入はバックエンド側で除外済み
+                for delta in backend.generate_polled_stream(prompt, params,header,current_text,cut_mode,exepath,max_new_tokens,session,
+                                                            cancel_key=cancel_key):
+                    if "Over Max Tokens" in delta:
                         gr.Info("最大context長を超過しています。\ncontext長圧縮方式を「シンプル」に変更してください。")
-                        acc=tail_ereaser(acc,"Over Max Tokens")
-                    yield {output_display:base+acc}
+                        delta=tail_ereaser(delta,"Over Max Tokens")
+                    delta=brackets.feed(delta)
+                    if stream is not None:
+                        delta=stream.feed(delta)
+                    if delta:
+                        chunks.append(delta)
+                    yield {output_display:base+"".join(chunks)}
             except Exception as e:
-                yield acc + f"\n\n[ERROR] streaming failed: {e}\n"
+                yield {output_display:"".join(chunks) + f"\n\n[ERROR] streaming failed: {e}\n"}
             finally:
-                if replace:
-                    for item in replacelist.keys():
-                        acc=acc.replace(item,random.choice(replacelist[item]))
-                    yield {output_display:base+acc}
-                else:
-                    yield {output_display:base+acc}
+                tail=brackets.flush()
+                if stream is not None:
+                    tail=stream.feed(tail)+stream.flush()
+                chunks.append(tail)
+                yield {output_display:base+"".join(chunks),
+                       prompt_info:_prompt_info(session),
+                       cand_row:gr.update(visible=False)}
+
+        def _prompt_info(session: Optional[SessionState]) -> str:
+            session=session if session is not None else backend.session
+            reuse=session.prompt_reuse
+            info=f"プロンプト再利用（推定）: {reuse['ratio']:.0%}"
+            if len(backend.pool.endpoints)>1:
+                info+=f" / 接続先: {session.endpoint}"
+            return info
+
+        def _stream_candidates(prompt,params,header,current_text,cut_mode,exepath,max_new_tokens,k,replace,replacer,session,cancel_key):
+            """
+            k 本の候補を並べて生成する。本文はそのままで、採用ボタンで選んだ候補を足す。
+            """
+            chunks: List[List[str]] = [[] for _ in range(k)]
+            brackets=[BracketStripper() for _ in range(k)]
+            streams=[StreamingReplacer(replacer) if replace and replacer else None for _ in range(k)]
+
+            def layout():
+                view={cand_row:gr.update(visible=True)}
+                for i in range(MAX_CANDIDATES):
+                    view[cand_cols[i]]=gr.update(visible=i<k)
+                    view[cand_boxes[i]]="".join(chunks[i]) if i<k else ""
+                return view
+
+            yield layout()
+            try:
+                for i,delta in backend.generate_candidates(prompt,params,header,current_text,cut_mode,exepath,max_new_tokens,
+                                                           k=k,session=session,cancel_key=cancel_key):
+                    if "Over Max Tokens" in delta:
+                        gr.Info("最大context長を超過しています。\ncontext長圧縮方式を「シンプル」に変更してください。")
+                        delta=delta.replace("Over Max Tokens","")
+                    delta=brackets[i].feed(delta)
+                    if streams[i] is not None:
+                        delta=streams[i].feed(delta)
+                    if delta:
+                        chunks[i].append(delta)
+                        yield {cand_boxes[i]:"".join(chunks[i])}
+            except Exception as e:
+                chunks[0].append(f"\n\n[ERROR] streaming failed: {e}\n")
+            finally:
+                for i in range(k):
+                    tail=brackets[i].flush()
+                    if streams[i] is not None:
+                        tail=streams[i].feed(tail)+streams[i].flush()
+                    chunks[i].append(tail)
+                yield dict(layout(),**{prompt_info:_prompt_info(session)})
         
         
 
-        retry_btn.click(_push_history,inputs=[output_display,undo_stack,redo_stack],outputs=[undo_stack,redo_stack]).then(
+        # 生成中にもう一度リトライしたら、同じセッションの前の生成はバックエンド側で止める
+        retry_btn.click(_push_history,inputs=[output_display,history],outputs=[history],trigger_mode="multiple").then(
             lambda x:gr.update(interactive=False),inputs=[output_display],outputs=[output_display]
         ).then(
             on_retry_stream,
@@ -335,66 +420,120 @@ def build_ui() -> gr.Blocks:
                 output_display,
                 title, genre, characters, background,additional, free_instr,
                 temperature, top_k, top_p, repeat_penalty, max_new_tokens,
-                doc_state,replace_token,gscripts_state,cut_mode, koboldcpp_exe
+                replace_token,gscripts_state,cut_mode, koboldcpp_exe, session_state, n_candidates
             ],
-            outputs=[output_display],
+            outputs=[output_display,prompt_info,cand_row,*cand_cols,*cand_boxes],
+            # 同時に生成できる数は BackendPool が接続先の数に合わせて制限する（空くまで順番待ち）
+            concurrency_limit=None,
         ).then(
             lambda x:gr.update(interactive=True),inputs=[output_display],outputs=[output_display]
         )
 
-        def on_undo(current_text: str, undo_stack: List[str], redo_stack: List[str]):
-            new_text, undo_stack, redo_stack = _undo(current_text, undo_stack, redo_stack)
-            return new_text, undo_stack, redo_stack
+        def on_cancel(request: gr.Request):
+            # koboldcpp に中断を送る（止まった時点までの文章はリトライ側が表示する）
+            if request is not None:
+                backend.cancel(request.session_hash)
 
-        def on_redo(current_text: str, undo_stack: List[str], redo_stack: List[str]):
-            new_text, undo_stack, redo_stack = _redo(current_text, undo_stack, redo_stack)
-            return new_text, undo_stack, redo_stack
+        cancel_btn.click(on_cancel,inputs=[],outputs=[],concurrency_limit=None)
 
-        undo_btn.click(on_undo, inputs=[output_display, undo_stack, redo_stack], outputs=[output_display, undo_stack, redo_stack])
-        redo_btn.click(on_redo, inputs=[output_display, undo_stack, redo_stack], outputs=[output_display, undo_stack, redo_stack])
+        def on_pick(current_text: str, candidate: str):
+            # 候補は生成前の本文の続きなので、そのまま後ろに足す
+            return current_text+candidate, gr.update(visible=False)
+
+        for box,btn in zip(cand_boxes,cand_btns):
+            btn.click(on_pick,inputs=[output_display,box],outputs=[output_display,cand_row])
+
+        def on_undo(current_text: str, history: TextHistory):
+            return _undo(current_text, history)
+
+        def on_redo(current_text: str, history: TextHistory):
+            return _redo(current_text, history)
+
+        undo_btn.click(on_undo, inputs=[output_display, history], outputs=[output_display, history])
+        redo_btn.click(on_redo, inputs=[output_display, history], outputs=[output_display, history])
         
         def on_download(modelname:str):
             exist,path= backend.check_download(modelname)
             if exist:
-                return "ダウンロード済み"
-            else:
-                check=True
-                while check:
-                    if os.path.exists(path):
-                        check=False
-                        yield "ダウンロード済み"
-                    else:
-                        yield "ダウンロード中"
+                yield "ダウンロード済み"
+                return
+            # 進捗は0.5秒ごとに見に行く（毎回yieldし続けない）
+            while True:
+                progress=backend.download_progress(path)
+                if progress is None:
+                    yield "ダウンロード中"
+                elif progress.finished:
+                    # 層数・コンテキスト長を gguf の値にする（次にモデルを選んだときのスライダーに反映）
+                    backend.refresh_model_spec(modelname)
+                    yield progress.status_text()
+                    if progress.state=="失敗":
+                        # 続く起動（.success）を止める
+                        raise gr.Error(progress.status_text())
+                    break
+                else:
+                    yield progress.status_text()
+                time.sleep(0.5)
         
-        def on_start(exe: str, model: str, layers: int, base_url: str,context_length: int):
-            backend.config.base_url = base_url
-            if not exe.strip():
-                yield {status:"koboldcpp を外部で起動済みなら exe は空でOKです。base_url だけ合わせてください。"}
-            # base_url のポートに合わせたいならここで parse してください（簡易に 5001 固定）
+        def on_recommend(model: str, vram: float):
+            rec,msg=backend.recommend_settings(model,vram or 0)
+            if rec is None:
+                return gr.update(),gr.update(),msg
+            return gr.update(value=rec.layers),gr.update(value=rec.context),msg
+
+        def on_start(exe: str, model: str, layers: int, url: str,context_length: int, vram: float = 0, warned=None):
+            backend.set_base_url(url)
             try:
-                port=5001
-                if not base_url.endswith("5001"):
-                    try:
-                        port=int(base_url.split(":")[-1])
-                    except Exception:
-                        port=5001
-                msg = backend.start(exe.strip(), model, layers=layers, port=port,context_length=context_length)
-                def is_listening(host: str="127.0.0.1",port: int = port, timeout: float =0.3)-> bool:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        s.settimeout(timeout)
-                        return s.connect_ex((host, port)) == 0
-                deadline=time.time()+300
-                while time.time()<deadline:
-                    if is_listening():
-                        yield "起動完了"
-                        break
-                    else:
-                        yield f"{msg}\n起動中"
-                if time.time()>deadline:
-                    yield "起動失敗"
+                if not exe.strip():
+                    msg="koboldcpp を外部で起動済みなら exe は空でOKです。base_url だけ合わせてください。"
+                else:
+                    # 起動に失敗すると数分かかるので、収まらない見込みなら先に知らせる
+                    warnings=backend.check_settings(model,int(layers),int(context_length),vram or 0)
+                    launch_key=[exe.strip(),model,int(layers),int(context_length)]
+                    if warnings and warned!=launch_key:
+                        _,recommended=backend.recommend_settings(model,vram or 0)
+                        yield {status:"\n".join(warnings+[recommended,"このまま起動する場合はもう一度「起動」を押してください。"]),
+                               warned_launch:launch_key}
+                        return
+                    yield {warned_launch:None}
+                    port=5001
+                    if not backend.config.base_url.endswith("5001"):
+                        try:
+                            port=int(backend.config.base_url.split(":")[-1])
+                        except Exception:
+                            port=5001
+                    msg = backend.start(exe.strip(), model, layers=layers, port=port,context_length=context_length)
+                probe=backend.probe_ready()
+                # 起動完了/失敗を待つ。表示の更新は1秒ごと（ロードの進み具合を出す）
+                while not probe.wait(timeout=1.0):
+                    if probe.done():
+                        yield {status:f"起動失敗: {probe.error}"}
+                        return
+                    yield {status:f"{msg}\n起動中 {probe.progress}"}
+                try:
+                    # モデル名・最大コンテクスト長はここで取得しておき、生成ごとには問い合わせない
+                    backend.model_info()
+                except Exception:
+                    pass
+                # 別モデルへの切り替えではポートが変わるので、base_url の表示も合わせる
+                yield {status:"起動完了",base_url:backend.base_urls()}
             except Exception as e:
                 yield {status:f"起動失敗: {e}"}
 
+        def on_standby(exe: str, model: str, layers: int, context_length: int):
+            # 次に使うモデルを先に起動しておき、起動ボタンですぐ切り替えられるようにする
+            try:
+                if not exe.strip():
+                    return "koboldcpp 実行ファイルパスを指定してください。"
+                return backend.prepare_standby(exe.strip(), model, layers=layers, context_length=context_length)
+            except Exception as e:
+                return f"起動失敗: {e}"
+
+        def on_local_tokenizer(enabled: bool, model: str):
+            # gguf の語彙でトークン数を数える。サーバの数と一致しない間はサーバに問い合わせる
+            backend.config.local_tokenizer=enabled
+            if enabled and backend.models and model in backend.models:
+                backend.load_local_tokenizer(backend.model_file(model))
+
         def on_stop():
             try:
                 return backend.stop()
@@ -402,11 +541,20 @@ def build_ui() -> gr.Blocks:
                 return f"終了失敗: {e}"
         
         def load_model_config(modelname):
+            context_info="LLMが参照できる文章量を指定します。長編や設定の細かい作品では大きくしてください。\nビデオメモリが小さい場合は小さくしてください。"
+            max_context=20480
             if modelname in backend.models.keys():
+                backend.refresh_model_spec(modelname)
                 new_layer= backend.models[modelname]["max_gpu_layer"]
+                trained=backend.models[modelname].get("context_size",0)
+                if trained:
+                    # 学習時の長さを超える指定もできる（koboldcpp が RoPE を伸ばす）ので上限は狭めない
+                    max_context=max(max_context,trained)
+                    context_info+=f"\nこのモデルの学習時のコンテキスト長: {trained}"
             else:
                 new_layer=0
-            return gr.Slider(-1, new_layer, value=-1, step=1, label="layers",info="大きいほどGPUを重点的に使用します。ビデオメモリが小さい場合やCPUで生成したい場合は小さくしてください。")
+            return (gr.Slider(-1, new_layer, value=-1, step=1, label="layers",info="大きいほどGPUを重点的に使用します。ビデオメモリが小さい場合やCPUで生成したい場合は小さくしてください。"),
+                    gr.Slider(2048, max_context, step=2048, label="context_length", interactive=True, info=context_info))
         
         def on_exit():
             """
@@ -418,6 +566,7 @@ def build_ui() -> gr.Blocks:
             try:
                 backend.stop()
                 backend.stop_aicompesser()
+                backend.token_cache.save()
             except Exception:
                 pass
             
@@ -449,7 +598,7 @@ def build_ui() -> gr.Blocks:
                 f.write(text)
             return filename
         
-        def export_json(main:str,title:str,genre:str,characters:str,background:str,add:str,free_instr:str,temperature:float,top_k:int,top_p:float,repeat:float,token:int,model:str,layers:int,context:int,undo:list,redo:list):
+        def export_json(main:str,title:str,genre:str,characters:str,background:str,add:str,free_instr:str,temperature:float,top_k:int,top_p:float,repeat:float,token:int,model:str,layers:int,context:int,history:TextHistory):
             os.makedirs("output",exist_ok=True)
             datas={
                 "main":main,
@@ -471,10 +620,10 @@ def build_ui() -> gr.Blocks:
                     "layers":layers,
                     "context":context
                 },
-                "dolist":{
-                    "undo":undo,
-                    "redo":redo
-                }
+                # undo/redo は差分形式（旧形式の全文リストも読み込める）
+                "dolist":history.to_dict(),
+                # 階層要約の途中結果（読み込み時に要約し直さずに済む）
+                "summaries":backend.export_summaries(main)
             }
             filename=f"output/{time.strftime('%Y%m%d-%H%M%S')}.json"
             with open(filename,mode="w",encoding="utf-8")as f:
@@ -499,11 +648,12 @@ def build_ui() -> gr.Blocks:
                         modellayer=0
                         modelcontext=2048
                     dolist=datas["dolist"]
+                    backend.import_summaries(datas.get("summaries",{}))
                     return datas["main"],datas["title"],datas["genre"],datas["characters"],datas["background"],datas["add"],datas["inst"],\
                         param["temp"],param["top_k"],param["top_p"],param["repeat"],param["tokens"],modelname,modellayer,\
-                            modelcontext,dolist["undo"],dolist["redo"]
+                            modelcontext,TextHistory.from_dict(dolist)
             else:
-                return "","","","","","","",1.0,40,0.95,1.1,64,"",30,2048,[],[]
+                return "","","","","","","",1.0,40,0.95,1.1,64,"",30,2048,TextHistory()
         
         ###ガタライズスクリプト作成編集タブ用
         def reload_dropdown(list:list):
@@ -539,16 +689,19 @@ def build_ui() -> gr.Blocks:
 
 
 
-        start_btn.click(on_download,inputs=[model_choice],outputs=[status]).then(on_start, inputs=[koboldcpp_exe, model_choice, layers, base_url,context_length], outputs=[status])
+        start_btn.click(on_download,inputs=[model_choice],outputs=[status]).success(on_start, inputs=[koboldcpp_exe, model_choice, layers, base_url,context_length,vram_gb,warned_launch], outputs=[status,base_url,warned_launch])
+        recommend_btn.click(on_recommend,inputs=[model_choice,vram_gb],outputs=[layers,context_length,status])
         stop_btn.click(on_stop, inputs=[], outputs=[status])
-        model_choice.change(load_model_config,inputs=[model_choice],outputs=[layers])
+        standby_btn.click(on_download,inputs=[model_choice],outputs=[status]).success(on_standby, inputs=[koboldcpp_exe, model_choice, layers, context_length], outputs=[status])
+        local_tokenizer.change(on_local_tokenizer,inputs=[local_tokenizer,model_choice],outputs=[])
+        model_choice.change(load_model_config,inputs=[model_choice],outputs=[layers,context_length])
         exit_button.click(on_exit,inputs=[],outputs=[output_display])
         update_button.click(gic.update_enacchi,inputs=[],outputs=[git_state]).then(on_restart,inputs=[git_state,output_display],outputs=[output_display])
         extxt.click(export_txt,inputs=[output_display],outputs=[downloadfile]).then(lambda x:gr.update(visible=True),
                                                                         inputs=[file_status],outputs=[file_status]).then(lambda x:gr.update(visible=True),
                                                                                                                         inputs=[downloadfile],outputs=[downloadfile])
         exjson.click(
-            export_json,inputs=[output_display,title,genre,characters,background,additional,free_instr,temperature,top_k,top_p,repeat_penalty,max_new_tokens,model_choice,layers,context_length,undo_stack,redo_stack],
+            export_json,inputs=[output_display,title,genre,characters,background,additional,free_instr,temperature,top_k,top_p,repeat_penalty,max_new_tokens,model_choice,layers,context_length,history],
                     outputs=[downloadfile]
                     ).then(
                         lambda x:gr.update(visible=True),inputs=[file_status],outputs=[file_status]
@@ -556,7 +709,7 @@ def build_ui() -> gr.Blocks:
                             lambda x:gr.update(visible=True),inputs=[downloadfile],outputs=[downloadfile])
         imjson.click(lambda x:gr.File(value=None,visible=True),inputs=[uploadfile],outputs=[uploadfile])
         uploadfile.upload(import_json,inputs=[uploadfile,model_choice],outputs=[output_display,
-                    title,genre,characters,background,additional,free_instr,temperature,top_k,top_p,repeat_penalty,max_new_tokens,model_choice,layers,context_length,undo_stack,redo_stack]).\
+                    title,genre,characters,background,additional,free_instr,temperature,top_k,top_p,repeat_penalty,max_new_tokens,model_choice,layers,context_length,history]).\
                         then(lambda x:gr.File(value=None,visible="hidden"),inputs=[uploadfile],outputs=[uploadfile])
         downloadfile.download(lambda x:gr.update(visible="hidden"),inputs=[file_status],outputs=[file_status])
 
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import ctypes
+import os
+import shutil
+import subprocess
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+from gguf_reader import GGUFInfo
+
+# koboldcpp の既定の --blasbatchsize（プロンプト処理で一度に流すトークン数）
+BATCH_SIZE = 512
+# 計算用バッファのうち、コンテキスト長などによらない分
+_COMPUTE_BASE = 256 * 1024 ** 2
+# ドライバ・画面表示などで使われる分として空けておく割合（最低 512MB）
+_VRAM_RESERVE = 0.1
+_VRAM_RESERVE_MIN = 512 * 1024 ** 2
+_RAM_RESERVE = 0.1
+
+GB = 1024 ** 3
+
+
+@dataclass(frozen=True)
+class MemoryEstimate:
+    """
+    koboldcpp が使うメモリの見積もり（バイト数）
+    """
+    vram: int
+    ram: int
+
+
+@dataclass(frozen=True)
+class Recommendation:
+    layers: int   # -1: VRAM が分からないので koboldcpp に任せる
+    context: int
+    estimate: MemoryEstimate
+
+
+def estimate(info: GGUFInfo, layers: int, context: int) -> MemoryEstimate:
+    """
+    --gpulayers layers / --contextsize context で起動したときのメモリ使用量。
+    - llama.cpp と同じく後ろの層から GPU に載せ、層数+1 なら出力層も載せる。KV キャッシュも層と一緒に載る
+    - 重みは gguf のテンソルの大きさそのもの（量子化の種類はここに反映されている）
+    - 計算用バッファは flash attention 無しの場合（注意のスコア + logits）で多めに見る
+    """
+    n_layer = len(info.layer_bytes)
+    layers = max(0, min(layers, n_layer + 1))
+    gpu = range(n_layer - min(layers, n_layer), n_layer)
+    kv = list(info.kv_bytes_per_token) + [0] * (n_layer - len(info.kv_bytes_per_token))
+    gpu_weights = sum(info.layer_bytes[i] for i in gpu)
+    gpu_kv = sum(kv[i] for i in gpu) * context
+    output_on_gpu = layers > n_layer
+    compute = _COMPUTE_BASE + info.n_head * context * BATCH_SIZE * 4
+    logits = info.n_vocab * BATCH_SIZE * 4
+    vram = 0
+    if layers:
+        vram = gpu_weights + gpu_kv + compute + (info.output_bytes + logits if output_on_gpu else 0)
+    ram = (sum(info.layer_bytes) - gpu_weights + info.other_bytes
+           + sum(kv) * context - gpu_kv
+           + (0 if output_on_gpu else info.output_bytes + logits)
+           + (_COMPUTE_BASE if layers else compute))
+    return MemoryEstimate(vram=vram, ram=ram)
+
+
+def vram_budget(vram: int) -> int:
+    return 0 if vram <= 0 else max(0, vram - max(int(vram * _VRAM_RESERVE), _VRAM_RESERVE_MIN))
+
+
+def ram_budget(ram: int) -> int:
+    return 0 if ram <= 0 else int(ram * (1 - _RAM_RESERVE))
+
+
+def fits(est: MemoryEstimate, ram: int, vram: int) -> bool:
+    """
+    ram / vram は使える量（0 は不明で確認しない）
+    """
+    if ram > 0 and est.ram > ram_budget(ram):
+        return False
+    if vram > 0 and est.vram > vram_budget(vram):
+        return False
+    return True
+
+
+def max_layers(info: GGUFInfo, context: int, ram: int, vram: int) -> Optional[int]:
+    """
+    context で収まる一番大きい --gpulayers。どうやっても収まらなければ None
+    """
+    if vram <= 0:
+        return 0 if fits(estimate(info, 0, context), ram, 0) else None
+    for layers in range(len(info.layer_bytes) + 1, -1, -1):
+        if fits(estimate(info, layers, context), ram, vram):
+            return layers
+    return None
+
+
+def recommend(info: GGUFInfo, contexts: Sequence[int], ram: int, vram: int) -> Optional[Recommendation]:
+    """
+    収まる中で一番大きい設定を選ぶ。GPU に載せる層を優先し、その層数を保てる範囲でコンテキストを伸ばす。
+    contexts は小さい順の候補（学習時の長さより長いものは選ばない）。
+    VRAM が分からないときは、全部 CPU に置いた場合で収まるコンテキストを選び、層数は koboldcpp に任せる（-1）。
+    """
+    if info.context_length:
+        contexts = [c for c in contexts if c <= info.context_length] or list(contexts[:1])
+    if not contexts or not info.layer_bytes:
+        return None
+    base = max_layers(info, contexts[0], ram, vram)
+    if base is None:
+        return None
+    best = contexts[0]
+    for context in contexts[1:]:
+        layers = max_layers(info, context, ram, vram)
+        if layers is None or layers < base:
+            break
+        best = context
+    layers = base if vram > 0 else -1
+    return Recommendation(layers=layers, context=best, estimate=estimate(info, max(base, 0), best))
+
+
+def check(info: GGUFInfo, layers: int, context: int, ram: int, vram: int) -> List[str]:
+    """
+    起動する前の確認。収まらない見込みなら理由を返す（空なら問題なし）。
+    layers=-1（koboldcpp に任せる）のときは VRAM は確認しない。
+    """
+    warnings: List[str] = []
+    auto = layers < 0
+    est = estimate(info, 0 if auto else layers, context)
+    if ram > 0 and est.ram > ram_budget(ram):
+        warnings.append(f"メインメモリが足りない見込みです（必要 {est.ram / GB:.1f}GB / 空き {ram / GB:.1f}GB）")
+    if not auto and vram > 0 and est.vram > vram_budget(vram):
+        warnings.append(f"ビデオメモリが足りない見込みです（必要 {est.vram / GB:.1f}GB / 使える量 {vram_budget(vram) / GB:.1f}GB）")
+    if info.context_length and context > info.context_length:
+        warnings.append(f"context_length が学習時の長さ（{info.context_length}）を超えています。文章が崩れることがあります")
+    return warnings
+
+
+def available_ram() -> int:
+    """
+    今使えるメインメモリ（バイト数）。分からなければ 0
+    """
+    try:
+        if os.name == "nt":
+            class MemoryStatus(ctypes.Structure):
+                _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                            ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                            ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                            ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                            ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+            status = MemoryStatus()
+            status.dwLength = ctypes.sizeof(MemoryStatus)
+            if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                return int(status.ullAvailPhys)
+            return 0
+        if os.path.exists("/proc/meminfo"):
+            with open("/proc/meminfo", mode="r", encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        return int(os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE"))
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def detect_vram() -> int:
+    """
+    NVIDIA の GPU があればビデオメモリの総量（バイト数）。分からなければ 0
+    """
+    exe = shutil.which("nvidia-smi")
+    if exe is None:
+        return 0
+    try:
+        out = subprocess.run([exe, "--query-gpu=memory.total", "--format=csv,noheader,nounits"],
+                             capture_output=True, text=True, timeout=5).stdout
+        return max((int(line) for line in out.split() if line.strip().isdigit()), default=0) * 1024 ** 2
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return 0
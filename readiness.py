@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional
+
+
+class ReadinessProbe:
+    """
+    koboldcpp の起動完了を待つためのプローブ。
+    - プロセスの標準出力を読み、最後の行を progress として見せる（ログはそのままコンソールにも流す）
+    - /api/v1/model などの確認を指数バックオフで行う（出力に変化があればすぐ確認し直す）
+    - 起動途中でプロセスが落ちたらすぐ失敗として通知する
+    - 結果は future（True: 起動完了 / False: 失敗）と ready イベントで受け取る
+    - add_ready_callback() の関数は、future が完了する前（待っている側が起きる前）に呼ばれる
+    """
+
+    def __init__(self, check: Callable[[], bool], proc: Optional[subprocess.Popen] = None,
+                 timeout: float = 300, min_interval: float = 0.1, max_interval: float = 2.0):
+        self.check = check
+        self.proc = proc
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.future: Future = Future()
+        self.ready = threading.Event()
+        self.progress = ""
+        self.error = ""
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+        self._ok: Optional[bool] = None
+
+    def start(self) -> "ReadinessProbe":
+        if self.proc is not None and self.proc.stdout is not None:
+            threading.Thread(target=self._read_output, daemon=True).start()
+        threading.Thread(target=self._probe, daemon=True).start()
+        return self
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        timeout 秒まで待つ。起動完了なら True、まだ/失敗なら False（失敗かどうかは done() と error で判断）
+        """
+        try:
+            return bool(self.future.result(timeout=timeout))
+        except TimeoutError:
+            return False
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def add_ready_callback(self, fn: Callable[[], None]) -> None:
+        """
+        起動完了時に呼ぶ関数を登録する（もう完了していればすぐ呼ぶ）
+        """
+        with self._lock:
+            if self._ok is None:
+                self._callbacks.append(fn)
+                return
+            ok = self._ok
+        if ok:
+            fn()
+
+    def _finish(self, ok: bool, error: str = "") -> None:
+        with self._lock:
+            if self._ok is not None:
+                return
+            self._ok = ok
+            callbacks = self._callbacks
+            self._callbacks = []
+        self.error = error
+        if ok:
+            for fn in callbacks:
+                try:
+                    fn()
+                except Exception as e:
+                    print(f"ready callback failed: {e}")
+            self.ready.set()
+        self.future.set_result(ok)
+
+    def _read_output(self) -> None:
+        # パイプを読み続けないと koboldcpp 側の書き込みが詰まるので、終了まで読み切る
+        for line in self.proc.stdout:
+            print(line, end="")
+            line = line.strip()
+            if line:
+                self.progress = line[-120:]
+                self._wake.set()
+
+    def _probe(self) -> None:
+        deadline = time.time() + self.timeout
+        interval = self.min_interval
+        while time.time() < deadline:
+            if self.proc is not None and self.proc.poll() is not None:
+                self._finish(False, f"koboldcpp が終了しました (code {self.proc.returncode}) {self.progress}")
+                return
+            try:
+                if self.check():
+                    self._finish(True)
+                    return
+            except Exception:
+                pass
+            # 出力があればすぐ、無ければ間隔を伸ばしながら確認し直す
+            self._wake.wait(interval)
+            if self._wake.is_set():
+                self._wake.clear()
+                interval = self.min_interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+        self._finish(False, "起動の確認がタイムアウトしました")
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import random
+import re
+from collections.abc import Mapping
+from typing import Dict, List, Optional
+
+
+_END = ""  # trie の終端マーカー（キーは空文字を含まないので衝突しない）
+
+
+class GscriptReplacer:
+    """
+    ガタライズスクリプトの置換をまとめて行うクラス。
+    - スクリプト読み込み時に全キーから trie 状の正規表現を1本だけ作る
+    - replace() は本文を1回なめるだけで全キーを置換する（キー数に依らず線形）
+    - 同じ位置で複数キーが当たる場合は最長一致を優先
+    - 置換後の文字列は再マッチしないので、dict の順番で結果が変わらない
+    - 候補の参照は一致したキーだけなので、LazyDecryptDict の遅延復号が効く
+    """
+
+    def __init__(self, table: Optional[Mapping] = None):
+        self.table: Mapping = table if table is not None else {}
+        keys = [k for k in self.table.keys() if isinstance(k, str) and k]
+        self.max_key_len = max((len(k) for k in keys), default=0)
+        self.pattern: Optional[re.Pattern] = re.compile(_build_trie_regex(keys)) if keys else None
+
+    def __bool__(self) -> bool:
+        return self.pattern is not None
+
+    def replace(self, text: str, seed: Optional[int] = None, rng: Optional[random.Random] = None) -> str:
+        """
+        text 中の全キーを1パスで置換する。
+        出現ごとに候補からランダムに1つ選ぶ。seed を渡すと結果を再現できる。
+        """
+        if self.pattern is None or not text:
+            return text
+        if rng is None:
+            rng = random.Random(seed) if seed is not None else random
+        table = self.table
+
+        def _choose(m: re.Match) -> str:
+            candidates = table[m.group(0)]
+            return rng.choice(candidates) if candidates else m.group(0)
+
+        return self.pattern.sub(_choose, text)
+
+
+def _build_trie_regex(keys: List[str]) -> str:
+    """
+    キーを trie にまとめてから正規表現にする。
+    単純な "a|ab|abc" の列挙と違い、各位置で trie を1本たどるだけで済み、
+    さらに量指定子の貪欲さで最長一致になる。
+    """
+    root: Dict[str, dict] = {}
+    for key in keys:
+        node = root
+        for ch in key:
+            node = node.setdefault(ch, {})
+        node[_END] = {}
+
+    def _to_regex(node: Dict[str, dict]) -> str:
+        alts = [re.escape(ch) + _to_regex(child) for ch, child in node.items() if ch != _END]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        if _END in node:
+            # ここで終わるキーもある -> 続きは任意（貪欲なので長い方から試す）
+            return "(?:" + body + ")?"
+        return body
+
+    return _to_regex(root)
+
+
+class StreamingReplacer:
+    """
+    ストリーミング生成の増分に対して逐次置換するためのラッパー。
+    - feed(delta) は確定した部分だけを置換して返す
+    - チャンク境界をまたぐ一致に備えて、末尾の (最長キー長 - 1) 文字程度だけ保留する
+    - 毎回処理するのは保留分 + 新しい増分だけなので、トークンあたりのコストは一定
+    - 生成終了時に flush() で保留分を吐き出す
+    """
+
+    def __init__(self, replacer: GscriptReplacer, seed: Optional[int] = None):
+        self.replacer = replacer
+        self.rng = random.Random(seed) if seed is not None else random
+        self.pending = ""
+
+    def feed(self, delta: str) -> str:
+        pattern = self.replacer.pattern
+        if pattern is None:
+            return delta
+        text = self.pending + delta
+        # cut より前から始まるキーは全体が既知のテキストに収まる -> 一致/不一致が確定している
+        cut = len(text) - self.replacer.max_key_len + 1
+        out: List[str] = []
+        pos = 0
+        for m in pattern.finditer(text):
+            if m.start() >= cut:
+                break
+            out.append(text[pos:m.start()])
+            out.append(self._choose(m.group(0)))
+            pos = m.end()
+        keep = max(pos, cut)
+        out.append(text[pos:keep])
+        self.pending = text[keep:]
+        return "".join(out)
+
+    def flush(self) -> str:
+        rest = self.replacer.replace(self.pending, rng=self.rng)
+        self.pending = ""
+        return rest
+
+    def _choose(self, key: str) -> str:
+        candidates = self.replacer.table[key]
+        return self.rng.choice(candidates) if candidates else key
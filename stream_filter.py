@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+from typing import List
+
+
+class BracketStripper:
+    """
+    ストリーミング出力から 【...】 を取り除くフィルタ。
+    re.sub(r'【.*?】', "", text) と同じ結果を、増分だけを見て作る。
+    - 【 を見たら「括弧内」状態になり、以降の文字は pending に保留する
+    - 】 が来たら pending ごと捨てる（閉じ括弧まで最短一致なので入れ子も同じ扱い）
+    - 】 より先に改行が来たら一致しない（. は改行にマッチしない）ので pending をそのまま吐く
+    - 生成終了時は flush() で閉じられなかった pending を吐く
+    """
+
+    def __init__(self, open_char: str = "【", close_char: str = "】"):
+        self.open_char = open_char
+        self.close_char = close_char
+        self.inside = False
+        self.pending: List[str] = []
+
+    def feed(self, delta: str) -> str:
+        out: List[str] = []
+        start = 0  # 括弧外で、まだ out に入れていない区間の先頭
+        for i, ch in enumerate(delta):
+            if not self.inside:
+                if ch == self.open_char:
+                    out.append(delta[start:i])
+                    self.inside = True
+                    self.pending = [ch]
+                continue
+            if ch == self.close_char:
+                self.inside = False
+                self.pending = []
+                start = i + 1
+            elif ch == "\n":
+                self.inside = False
+                out.extend(self.pending)
+                self.pending = []
+                start = i
+            else:
+                self.pending.append(ch)
+        if not self.inside:
+            out.append(delta[start:])
+        return "".join(out)
+
+    def flush(self) -> str:
+        rest = "".join(self.pending)
+        self.inside = False
+        self.pending = []
+        return rest
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from token_cache import text_hash
+
+
+class SummaryCache:
+    """
+    AI圧縮の要約結果のキャッシュ。キーはチャンク本文のハッシュ。
+    リトライ間で変わっていないチャンクは要約し直さない。
+    """
+
+    def __init__(self, maxsize: int = 5_000):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, text: str) -> Optional[str]:
+        key = text_hash(text)
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, text: str, summary: str) -> None:
+        key = text_hash(text)
+        with self._lock:
+            self._data[key] = summary
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def to_dict(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._data)
+
+    def update(self, datas: Dict[str, str]) -> None:
+        with self._lock:
+            for key, summary in datas.items():
+                if isinstance(summary, str):
+                    self._data[key] = summary
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
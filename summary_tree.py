@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from summary_cache import SummaryCache
+from token_cache import text_hash
+
+
+class SummaryTree:
+    """
+    長編向けの階層要約。
+    - 葉: 本文のチャンク（token_chunk_lines 行ずつ）の要約
+    - 節: 先頭から fanout 個ずつ区切った子の要約をつなげて、さらに要約したもの（章の要約）
+    - 区切りは常に先頭から数えるので、末尾に書き足しても既存の節は変わらない
+    - 各節は「子の要約をつなげた文字列」のハッシュでキャッシュするので、
+      下の本文が変わった節だけが要約し直される
+    summaries_for() は古い方から「最上位の節, ..., 端数になった下位の要約」の順に返す。
+    要約の個数は (fanout-1) * 段数 程度に収まり、本文がどれだけ長くても増えない。
+    """
+
+    def __init__(self, cache: SummaryCache, summarize: Callable[[str], str], fanout: int = 8, workers: int = 4):
+        self.cache = cache
+        self.summarize = summarize
+        self.fanout = max(2, fanout)
+        self.workers = max(1, workers)
+
+    def summaries_for(self, leaves: List[str]) -> List[str]:
+        level = self._summarize_all(leaves)
+        tail: List[str] = []
+        while len(level) >= self.fanout:
+            full = len(level) // self.fanout * self.fanout
+            # 端数は上の段にまとめず、そのまま後ろに残す（より新しい本文なので後ろ側）
+            tail = level[full:] + tail
+            parents = ["\n".join(level[i:i + self.fanout]) for i in range(0, full, self.fanout)]
+            level = self._summarize_all(parents)
+        return level + tail
+
+    def export_for(self, leaves: List[str]) -> Dict[str, str]:
+        """
+        leaves に関係する要約だけを {ハッシュ: 要約} で返す（json保存用、要約はしない）
+        """
+        out: Dict[str, str] = {}
+        level = list(leaves)
+        while level:
+            summaries = [self.cache.get(t) for t in level]
+            for t, s in zip(level, summaries):
+                if s is not None:
+                    out[text_hash(t)] = s
+            if len(level) < self.fanout or any(s is None for s in summaries):
+                break
+            full = len(level) // self.fanout * self.fanout
+            level = ["\n".join(summaries[i:i + self.fanout]) for i in range(0, full, self.fanout)]
+        return out
+
+    def _summarize_all(self, texts: List[str]) -> List[str]:
+        results = [self.cache.get(t) for t in texts]
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.workers) as ex:
+                for i, summary in zip(missing, ex.map(lambda i: self.summarize(texts[i]), missing)):
+                    self.cache.put(texts[i], summary)
+                    results[i] = summary
+        return results
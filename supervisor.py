@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+from readiness import ReadinessProbe
+
+
+def popen_kobold(cmd: List[str], capture: bool = True) -> subprocess.Popen:
+    """
+    koboldcpp を独立したプロセスグループで起動する。
+    Windows は CREATE_NEW_PROCESS_GROUP（CTRL_BREAK_EVENT を送れるように）、
+    Linux/macOS は新しいセッション（killpg で子プロセスごと止められるように）。
+    """
+    kwargs = {}
+    if os.name == "nt":
+        kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+    if capture:
+        kwargs.update(stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return subprocess.Popen(cmd, text=True, encoding="utf-8", errors="replace", bufsize=1, **kwargs)
+
+
+def terminate_process(proc: Optional[subprocess.Popen], timeout: float = 5) -> None:
+    """
+    穏やかに止めて、止まらなければ強制終了する。
+    Windows: CTRL_BREAK_EVENT -> terminate -> kill
+    POSIX:   プロセスグループに SIGTERM -> SIGKILL
+    """
+    if proc is None or proc.poll() is not None:
+        return
+    if os.name == "nt":
+        try:
+            proc.send_signal(signal.CTRL_BREAK_EVENT)
+        except (OSError, ValueError):
+            pass
+        proc.terminate()
+        try:
+            proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait(timeout=timeout)
+        return
+    try:
+        pgid = os.getpgid(proc.pid)
+    except ProcessLookupError:
+        return
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait(timeout=timeout)
+    except ProcessLookupError:
+        pass
+
+
+def free_port(host: str = "127.0.0.1") -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+@dataclass
+class KoboldInstance:
+    """
+    起動した koboldcpp 1つ分
+    """
+    key: str                      # モデルと起動設定の識別子（同じなら使い回せる）
+    build_cmd: Callable[[int], List[str]]
+    port: int
+    host: str = "127.0.0.1"
+    proc: Optional[subprocess.Popen] = None
+    probe: Optional[ReadinessProbe] = None
+    restarts: int = 0
+    started: float = field(default_factory=time.time)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+
+class KoboldSupervisor:
+    """
+    koboldcpp プロセスの監視役。
+    - active: 今生成に使っているインスタンス / standby: 裏で起動しておくインスタンス
+      / pending: swap() で起動中の、準備ができたら active になるインスタンス
+    - swap(): 新しいモデルを別ポートで起動し、準備ができた時点で on_switch(base_url) を呼んで
+      接続先を切り替えてから古い方を止める（切り替えの間も古い方で生成できる）
+    - active が落ちたら max_restarts 回まで同じ設定で起動し直す
+    """
+
+    def __init__(self, check_url: Callable[[str], bool], on_switch: Callable[[str], None],
+                 max_restarts: int = 3, ready_timeout: float = 300):
+        self.check_url = check_url
+        self.on_switch = on_switch
+        self.max_restarts = max_restarts
+        self.ready_timeout = ready_timeout
+        self.active: Optional[KoboldInstance] = None
+        self.standby: Optional[KoboldInstance] = None
+        self.pending: Optional[KoboldInstance] = None
+        self._lock = threading.RLock()
+        self._stopping = False
+        threading.Thread(target=self._monitor, daemon=True).start()
+
+    def launch(self, key: str, build_cmd: Callable[[int], List[str]], port: int) -> KoboldInstance:
+        """
+        active を(止めてから)起動する。最初の起動や、切り替え不要な場合用。
+        """
+        with self._lock:
+            old = self.active
+            pending = self.pending
+            self.pending = None  # 起動中の切り替えは取り消す
+            self.active = self._spawn(key, build_cmd, port)
+        for inst in (old, pending):
+            terminate_process(inst.proc if inst else None)
+        return self.active
+
+    def prepare_standby(self, key: str, build_cmd: Callable[[int], List[str]]) -> KoboldInstance:
+        """
+        次に使うモデルを空いているポートで裏で起動しておく
+        """
+        with self._lock:
+            if self.standby is not None and self.standby.key == key and self.standby.alive():
+                return self.standby
+            old = self.standby
+            self.standby = self._spawn(key, build_cmd, free_port())
+        terminate_process(old.proc if old else None)
+        return self.standby
+
+    def swap(self, key: str, build_cmd: Callable[[int], List[str]]) -> KoboldInstance:
+        """
+        key のモデルに切り替える。standby が同じモデルならそれを使い、無ければ別ポートで起動する。
+        準備ができたら接続先を切り替え、古い active を止める。
+        起動中の別の切り替え（pending）があればそれは止める（後から来た切り替えが優先）。
+        """
+        with self._lock:
+            pending = self.pending
+            if pending is not None and pending.key == key and pending.alive():
+                return pending  # 同じモデルへの切り替えがすでに進んでいる
+            target = self.standby if (self.standby is not None and self.standby.key == key and self.standby.alive()) else None
+            if target is None:
+                target = self._spawn(key, build_cmd, free_port())
+            else:
+                self.standby = None
+            self.pending = target
+        if pending is not None:
+            threading.Thread(target=terminate_process, args=(pending.proc,), daemon=True).start()
+
+        def promote() -> None:
+            with self._lock:
+                if self.pending is not target:
+                    return  # 新しい切り替え・stop_all で取り消された
+                self.pending = None
+                old = self.active
+                self.active = target
+                self.on_switch(target.base_url)
+            if old is not None and old is not target:
+                # 止めるのは切り替えた後。待たせないように別スレッドで
+                threading.Thread(target=terminate_process, args=(old.proc,), daemon=True).start()
+
+        target.probe.add_ready_callback(promote)
+        return target
+
+    def stop_all(self) -> None:
+        self._stopping = True
+        with self._lock:
+            instances = [self.active, self.standby, self.pending]
+            self.active = None
+            self.standby = None
+            self.pending = None
+        for inst in instances:
+            if inst is not None:
+                terminate_process(inst.proc)
+        self._stopping = False
+
+    def _spawn(self, key: str, build_cmd: Callable[[int], List[str]], port: int) -> KoboldInstance:
+        inst = KoboldInstance(key=key, build_cmd=build_cmd, port=port)
+        inst.proc = popen_kobold(build_cmd(port))
+        inst.probe = ReadinessProbe(lambda: self.check_url(inst.base_url), inst.proc,
+                                    timeout=self.ready_timeout).start()
+        return inst
+
+    def _monitor(self) -> None:
+        while True:
+            time.sleep(1.0)
+            if self._stopping:
+                continue
+            with self._lock:
+                inst = self.active
+                if inst is None or inst.alive() or inst.proc is None:
+                    continue
+                # 起動に一度も成功していないものは再起動しない（設定ミスのループを避ける）
+                if inst.probe is None or not inst.probe.ready.is_set() or inst.restarts >= self.max_restarts:
+                    continue
+                print(f"koboldcpp (port {inst.port}) が終了したため再起動します ({inst.restarts + 1}/{self.max_restarts})")
+                restarted = self._spawn(inst.key, inst.build_cmd, inst.port)
+                restarted.restarts = inst.restarts + 1
+                self.active = restarted
+                self.on_switch(restarted.base_url)
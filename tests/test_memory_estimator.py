@@ -0,0 +1,129 @@
+import struct
+
+import pytest
+
+import memory_estimator as me
+from gguf_reader import read_info
+
+MiB = 1024 ** 2
+GiB = 1024 ** 3
+
+_UINT32, _STRING, _ARRAY = 4, 8, 9
+_F32 = 0
+
+
+def _str(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return struct.pack("<Q", len(data)) + data
+
+
+def _kv(key: str, vtype: int, payload: bytes) -> bytes:
+    return _str(key) + struct.pack("<I", vtype) + payload
+
+
+def write_gguf(path, kvs, tensors, alignment=32):
+    """
+    GGUF v3 を書く。tensors は (名前, バイト数) の並び（F32 の1次元として書く）。
+    """
+    infos = b""
+    offset = 0
+    for name, nbytes in tensors:
+        infos += _str(name) + struct.pack("<IQIQ", 1, nbytes // 4, _F32, offset)
+        offset += (nbytes + alignment - 1) // alignment * alignment
+    head = b"GGUF" + struct.pack("<IQQ", 3, len(tensors), len(kvs)) + b"".join(kvs) + infos
+    head += b"\0" * ((len(head) + alignment - 1) // alignment * alignment - len(head))
+    with open(path, "wb") as f:
+        f.write(head + b"\0" * offset)
+
+
+@pytest.fixture
+def info(tmp_path):
+    path = tmp_path / "tiny.gguf"
+    kvs = [
+        _kv("general.architecture", _STRING, _str("llama")),
+        _kv("llama.block_count", _UINT32, struct.pack("<I", 2)),
+        _kv("llama.context_length", _UINT32, struct.pack("<I", 4096)),
+        _kv("llama.embedding_length", _UINT32, struct.pack("<I", 64)),
+        _kv("llama.attention.head_count", _UINT32, struct.pack("<I", 4)),
+        _kv("llama.attention.head_count_kv", _UINT32, struct.pack("<I", 2)),
+        _kv("tokenizer.ggml.tokens", _ARRAY, struct.pack("<IQ", _STRING, 10) + b"".join(_str(f"t{i}") for i in range(10))),
+        _kv("tokenizer.chat_template", _STRING, _str("{{ messages }}")),
+    ]
+    tensors = [
+        ("token_embd.weight", 2048),
+        ("blk.0.attn_q.weight", 320),
+        ("blk.0.ffn_up.weight", 640),
+        ("blk.1.attn_q.weight", 320),
+        ("blk.1.ffn_up.weight", 640),
+        ("output_norm.weight", 64),
+        ("output.weight", 1280),
+    ]
+    write_gguf(path, kvs, tensors)
+    return read_info(str(path))
+
+
+def test_read_info(info):
+    assert info.architecture == "llama"
+    assert info.block_count == 2
+    assert info.context_length == 4096
+    assert info.chat_template == "{{ messages }}"
+    assert info.layer_bytes == (960, 960)
+    assert info.output_bytes == 64 + 1280
+    assert info.other_bytes == 2048
+    # head_dim = 64 / 4 = 16, K と V で 2 * 16、KV ヘッド 2、f16 で 2 バイト
+    assert info.kv_bytes_per_token == (2 * (16 + 16) * 2,) * 2
+    assert info.max_gpu_layer == 3
+    assert (info.n_embd, info.n_head, info.n_vocab) == (64, 4, 10)
+
+
+def test_estimate(info):
+    compute = 256 * MiB + 4 * 2048 * me.BATCH_SIZE * 4
+    logits = 10 * me.BATCH_SIZE * 4
+    cpu = me.estimate(info, 0, 2048)
+    assert cpu.vram == 0
+    assert cpu.ram == 1920 + 2048 + 2 * 128 * 2048 + 1344 + logits + compute
+    one = me.estimate(info, 1, 2048)
+    assert one.vram == 960 + 128 * 2048 + compute
+    full = me.estimate(info, 3, 2048)
+    assert full.vram == 1920 + 2 * 128 * 2048 + compute + 1344 + logits
+    assert full.ram == 2048 + 256 * MiB
+    # 層数より大きい指定は全部載せと同じ
+    assert me.estimate(info, 99, 2048) == full
+
+
+def test_max_layers(info):
+    # 800MB の予算は 800MB - 512MB（最低限空けておく分）
+    assert me.max_layers(info, 2048, 8 * GiB, 800 * MiB) == 3
+    assert me.max_layers(info, 4096, 8 * GiB, 800 * MiB) == 0
+    assert me.max_layers(info, 4096, 8 * GiB, 0) == 0
+    assert me.max_layers(info, 2048, 256 * MiB, 0) is None
+
+
+def test_recommend_keeps_gpu_layers(info):
+    rec = me.recommend(info, [2048, 4096, 8192], 8 * GiB, 800 * MiB)
+    assert (rec.layers, rec.context) == (3, 2048)
+    rec = me.recommend(info, [2048, 4096, 8192], 8 * GiB, 2 * GiB)
+    # 学習時の長さ（4096）を超えるものは選ばない
+    assert (rec.layers, rec.context) == (3, 4096)
+
+
+def test_recommend_vram_unknown(info):
+    rec = me.recommend(info, [2048, 4096], 8 * GiB, 0)
+    assert (rec.layers, rec.context) == (-1, 4096)
+    assert rec.estimate.vram == 0
+
+
+def test_recommend_does_not_fit(info):
+    assert me.recommend(info, [2048, 4096], 256 * MiB, 0) is None
+
+
+def test_check(info):
+    assert me.check(info, 3, 2048, 8 * GiB, 800 * MiB) == []
+    warnings = me.check(info, 3, 4096, 8 * GiB, 800 * MiB)
+    assert len(warnings) == 1 and "ビデオメモリ" in warnings[0]
+    # layers=-1 は VRAM を確認しない
+    assert me.check(info, -1, 4096, 8 * GiB, 800 * MiB) == []
+    warnings = me.check(info, -1, 8192, 8 * GiB, 0)
+    assert len(warnings) == 1 and "学習時の長さ" in warnings[0]
+    warnings = me.check(info, 0, 2048, 256 * MiB, 0)
+    assert len(warnings) == 1 and "メインメモリ" in warnings[0]
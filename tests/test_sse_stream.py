@@ -0,0 +1,81 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from backend import KoboldCppBackend, KoboldCppConfig
+from backend_pool import Generation
+
+TOKENS = ["吾輩", "は", "猫", "である"]
+DELAY = 0.2
+
+
+def _serve(chunked: bool):
+    """
+    koboldcpp と同じ形で SSE を返すスタブ。chunked=False なら Content-Length も
+    Transfer-Encoding も付けず、接続を閉じて終わる（koboldcpp の http.server と同じ）。
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" if chunked else "HTTP/1.0"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            if chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def write(text: str) -> None:
+                data = text.encode("utf-8")
+                if chunked:
+                    data = f"{len(data):x}\r\n".encode() + data + b"\r\n"
+                self.wfile.write(data)
+                self.wfile.flush()
+
+            for i, token in enumerate(TOKENS):
+                finish = "stop" if i == len(TOKENS) - 1 else None
+                write("event: message\ndata: " + json.dumps({"token": token, "finish_reason": finish}) + "\n\n")
+                time.sleep(DELAY)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture(params=[False, True], ids=["close-delimited", "chunked"])
+def backend(request):
+    server = _serve(chunked=request.param)
+    yield KoboldCppBackend(KoboldCppConfig(base_url=f"http://127.0.0.1:{server.server_address[1]}",
+                                           token_cache_path=None, gguf_cache_path=None))
+    server.shutdown()
+
+
+def test_tokens_arrive_while_generating(backend):
+    start = time.time()
+    arrived = []
+    for token in backend._sse_stream({"prompt": "x"}, Generation()):
+        arrived.append((token, time.time() - start))
+    assert [t for t, _ in arrived] == TOKENS
+    # 最初のトークンは生成の終わりを待たずに届く
+    assert arrived[0][1] < DELAY * 2
+    assert arrived[-1][1] - arrived[0][1] >= DELAY * (len(TOKENS) - 2)
+
+
+def test_cancel_stops_mid_stream(backend):
+    gen = Generation()
+    received = []
+    start = time.time()
+    for token in backend._sse_stream({"prompt": "x"}, gen):
+        received.append(token)
+        gen.cancelled.set()
+    assert received == TOKENS[:1]
+    assert time.time() - start < DELAY * (len(TOKENS) - 1)
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional, Tuple
+
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class TokenCountCache:
+    """
+    トークン数のキャッシュ。キーは (モデル名, 本文のハッシュ)。
+    - 小説の大部分はリトライ間で変わらないので、段落ごとの数を覚えておけば
+      新しく書かれた/編集された部分だけ tokencount すれば済む
+    - maxsize を超えたら古いものから捨てる（LRU）
+    - path を渡すとJSONに保存/読み込みして、再起動後も同じモデルなら使い回す
+      （保存は start_autosave() の別スレッドでまとめて行い、生成のたびには書かない）
+    """
+
+    def __init__(self, maxsize: int = 50_000, path: Optional[str] = None):
+        self.maxsize = maxsize
+        self.path = path
+        self._data: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # 書き込みは1つずつ
+        self._dirty = False
+        self._autosave: Optional[threading.Thread] = None
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+
+    def get(self, model: str, text: str) -> Optional[int]:
+        key = (model, text_hash(text))
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, model: str, text: str, count: int) -> None:
+        key = (model, text_hash(text))
+        with self._lock:
+            self._data[key] = int(count)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            self._dirty = True
+
+    def count(self, model: str, text: str, tokenize: Callable[[str], int]) -> int:
+        """
+        キャッシュにあればそれを、無ければ tokenize(text) して覚える
+        """
+        value = self.get(model, text)
+        if value is None:
+            value = int(tokenize(text))
+            self.put(model, text, value)
+        return value
+
+    def count_many(self, model: str, texts: Iterable[str], tokenize: Callable[[str], int]) -> List[int]:
+        return [self.count(model, t, tokenize) for t in texts]
+
+    def clear(self, model: Optional[str] = None) -> None:
+        with self._lock:
+            if model is None:
+                self._data.clear()
+            else:
+                for key in [k for k in self._data if k[0] == model]:
+                    del self._data[key]
+            self._dirty = True
+
+    # ---- disk store ----
+    def load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, mode="r", encoding="utf-8") as f:
+                datas = json.load(f)
+        except (OSError, ValueError):
+            return  # 壊れていたら無視して作り直す
+        with self._lock:
+            for model, entries in datas.get("models", {}).items():
+                for h, count in entries.items():
+                    self._data[(model, h)] = int(count)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            self._dirty = False
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                models: dict = {}
+                for (model, h), count in self._data.items():
+                    models.setdefault(model, {})[h] = count
+                self._dirty = False
+            try:
+                write_json_atomic(self.path, {"version": 1, "models": models})
+            except OSError:
+                with self._lock:
+                    self._dirty = True  # 次の機会に書き直す
+                raise
+
+    def start_autosave(self, interval: float = 30.0) -> None:
+        """
+        interval 秒ごとに、変更があれば保存する（デーモンスレッド）
+        """
+        if not self.path or self._autosave is not None:
+            return
+
+        def run() -> None:
+            while True:
+                time.sleep(interval)
+                try:
+                    self.save()
+                except OSError as e:
+                    print(f"トークン数キャッシュを保存できませんでした: {e}")
+
+        self._autosave = threading.Thread(target=run, daemon=True)
+        self._autosave.start()
+
+
+def write_json_atomic(path: str, datas: dict) -> None:
+    """
+    同じディレクトリの一時ファイルに書いてから置き換える（一時ファイル名は呼び出しごとに別）
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, mode="w", encoding="utf-8") as f:
+            json.dump(datas, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise